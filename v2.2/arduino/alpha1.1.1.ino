@@ -3,26 +3,34 @@
 #define SERVO_PIN 9
 #define LED_PIN 8
 #define BAUD 9600
+#define PROTO_VERSION 1 // Version of the framed protocol we understand. See framedCommand()
 
 /*
   Project: Coopener (Chicken Coop Door Opener)
-  www.makeitbreakitfixit.com - Coopener - v.alpha1.1
-  
+  www.makeitbreakitfixit.com - Coopener - v.alpha1.2
+
   The Coopener project is the first of many modules which will make up my
-  Smart Home. 
-  
-  The Arduino will listen on the serial link until it receives a command, it will 
+  Smart Home.
+
+  The Arduino will listen on the serial link until it receives a command, it will
   then execute the command and acknowledge this by responding with the same command
   it received.
   All commands are <rcvChars> in length and are enclosed within braces, { }
-  
+  Newer Python also speaks a framed protocol, see framedCommand().
+
   When the coop door is closed an small LED is turned on, this is so at night
   I will easily be able to tell from a distance that the door is closed.
-  
+
   Versions:
   alpha1.1.1 (24/10/2016)
   - Added ability for Arduino to be polled on its current state and return whether
     the door is open or closed. see: returnState(). Relevant Python v1.1.1alpha.
+  alpha1.2
+  - Added framed protocol with request IDs and a CRC. Python asks for it with {proto}.
+  - The door now moves one step each loop() instead of in one go, so commands
+    (eg. status) are still answered while the door is moving.
+  - A command still waiting for its ACK when the door is sent the other way is
+    answered straight away with the new state, so it isn't sent again.
 */
 
 
@@ -31,11 +39,22 @@ int openPos = 160; // Door fully open position for servo
 int closePos = 80; // Door fully closed position for servo
 int rcvChars = 8; // Max number of protocol chars to receive from serial. The
                   // serial protocol used between Ard and Python shouldnt exceed this
+int stepDelay = 50; // Milliseconds between each 1 degree step, so door doesnt move too quick
 bool testing = false; // Set to true when testing.
 // *******************************************
 
 Servo myservo;  // Create servo object to control the servo
 int pos = 0;    // Store the servo position
+int target = 0; // Position the servo is moving to
+unsigned long lastStep = 0; // millis() when the servo last moved
+
+char serialData[24]; // Holds the message being received. Big enough for a frame
+int numChars = 0;    // Number of chars in serialData so far
+char msgStart = 0;   // '{' or '[' while receiving a message, otherwise 0
+
+bool ackBraces = false; // Send {open}/{close} when the door stops moving
+int ackSeqs[8];         // Request IDs of framed open/close commands to answer when the door stops moving
+int numAcks = 0;
 
 void setup () {
     myservo.attach(SERVO_PIN);  // Attaches pin <SERVO_PIN> to the servo object
@@ -47,68 +66,148 @@ void setup () {
     Serial.println("*****************************************************");
     while (!Serial) {;} // Continue only when serial comms comes up
     pos = closePos; // Initial state of the door
+    target = closePos;
     myservo.write(pos); // servo starting position. This is fully open position
     if (testing) Serial.println("***TESTING MODE***");
 }
- 
+
 void loop () {
     if (testing) TestLoop(); // Open close door for testing purposes
     readSerial(); // Listen on serial for commands
+    moveDoor(); // Move the door a step if it isn't where it should be
   }
 
 void readSerial() {
-  // TODO: Insert checks to ensure code can handle malformed data. eg. Message
-  //       beginning with { but no closing }. Or message too long or invalid chars
-  if (Serial.find('{')) { // A protocol message must be enclosed in braces, { }
-    char serialData[(rcvChars+1)]; // Array holds incoming serial buffer. +1 for NULL char
-    int numChars = Serial.readBytesUntil('}', serialData, (rcvChars+1)); // Store chars until } is found
-    serialData[numChars] = NULL; // Add the NULL terminator
-    Serial.print("Received signal to "); Serial.println(serialData);
-    if ((String(serialData)) == "open") openDoor();
-    if ((String(serialData)) == "close") closeDoor();
-    if ((String(serialData)) == "status") returnState();
+  // A protocol message must be enclosed in braces { } or be a frame [ ]. Anything
+  // else is ignored. Messages that are too long are dropped.
+  while (Serial.available() > 0) {
+    char c = Serial.read();
+    if (c == '{' || c == '[') { // Start of a message
+      msgStart = c;
+      numChars = 0;
+    } else if (msgStart == '{' && c == '}') {
+      serialData[numChars] = NULL; // Add the NULL terminator
+      msgStart = 0;
+      bracesCommand(serialData);
+    } else if (msgStart == '[' && c == ']') {
+      serialData[numChars] = NULL;
+      msgStart = 0;
+      framedCommand(serialData);
+    } else if (msgStart != 0) {
+      int maxChars = (msgStart == '{') ? rcvChars : (int)sizeof(serialData) - 1;
+      if (numChars < maxChars) serialData[numChars++] = c;
+      else msgStart = 0; // Too long, drop it
+    }
   }
 }
 
+void bracesCommand(char *command) {
+  Serial.print("Received signal to "); Serial.println(command);
+  if (strcmp(command, "open") == 0) moveTo(openPos, -1);
+  if (strcmp(command, "close") == 0) moveTo(closePos, -1);
+  if (strcmp(command, "status") == 0) returnState();
+  if (strcmp(command, "proto") == 0) { // Python asking if we understand the framed protocol
+    Serial.print("{proto"); Serial.print(PROTO_VERSION); Serial.println("}");
+  }
+}
+
+void framedCommand(char *frame) {
+  // A frame looks like [1:0a:open*5c]. 1 is the protocol version, 0a the request ID
+  // (2 hex digits) and 5c the CRC-8 (2 hex digits) of everything between [ and *.
+  // The answer is a frame with the same request ID, or "err" if the CRC is wrong.
+  char *star = strrchr(frame, '*');
+  if (star == NULL || frame[0] != '0' + PROTO_VERSION || frame[1] != ':') return;
+  *star = NULL;
+  char *end;
+  int seq = (int)strtol(frame + 2, &end, 16);
+  if (*end != ':') return; // Can't tell which request it is, so can't answer
+  if ((int)strtol(star + 1, NULL, 16) != crc8(frame)) {
+    sendFrame(seq, "err");
+    return;
+  }
+  char *command = end + 1;
+  if (strcmp(command, "open") == 0) moveTo(openPos, seq);
+  else if (strcmp(command, "close") == 0) moveTo(closePos, seq);
+  else if (strcmp(command, "status") == 0) sendFrame(seq, doorState());
+  else sendFrame(seq, "err");
+}
+
+byte crc8(const char *text) { // CRC-8, polynomial 0x07. Same as crc8() in Python
+  byte crc = 0;
+  while (*text) {
+    crc ^= *text++;
+    for (int i = 0; i < 8; i++) crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : (crc << 1);
+  }
+  return crc;
+}
+
+void sendFrame(int seq, const char *text) {
+  char body[20];
+  char frame[28];
+  snprintf(body, sizeof(body), "%d:%02x:%s", PROTO_VERSION, seq, text);
+  snprintf(frame, sizeof(frame), "[%s*%02x]", body, crc8(body));
+  Serial.println(frame);
+  Serial.flush(); // Wait for serial data to be sent before continuing
+}
+
+const char *doorState() { // Where the door is, or is going to be if it is moving
+  return (target == openPos) ? "open" : "close";
+}
+
 void returnState() { // Gets current state of the door and returns it via serial comms
-  if (pos == closePos) Serial.println("{close}"); // Let Python know door is closed
-  if (pos == openPos) Serial.println("{open}"); // Let Python know door is open
+  if (target == closePos) Serial.println("{close}"); // Let Python know door is closed
+  if (target == openPos) Serial.println("{open}"); // Let Python know door is open
   Serial.flush(); // Wait for serial data to be sent before continuing
 }
 
-void openDoor() {
-  if (pos == closePos) {
-    Serial.println("Opening door");
-    for (pos = closePos; pos < openPos; pos += 1) { // opens door in 1degree steps
-      myservo.write(pos);
-      delay(50); // delay so it doesnt move too quick
-    }
-    digitalWrite(LED_PIN, LOW); // Turn off light when door open
+void moveTo(int newTarget, int seq) {
+  // Start moving the door. The ACK is sent by moveDoor() once it gets there.
+  // seq is the request ID of a framed command, -1 for braces or -2 if no ACK is needed.
+  if (newTarget != target) {
+    target = newTarget;
+    Serial.println((target == openPos) ? "Opening door" : "Closing door");
+    // Anyone waiting for the door to go the other way is answered now, with where it is going instead.
+    // Otherwise Python would send their command again and drive the door back.
+    if (ackBraces) returnState();
+    for (int i = 0; i < numAcks; i++) sendFrame(ackSeqs[i], doorState());
+    numAcks = 0;
+    ackBraces = false;
   }
-  Serial.println("Door is now open");
-  Serial.println("{open}"); // ACK message to let Python know command was executed
-  Serial.flush(); // Wait for serial data to be sent before continuing
+  if (seq == -1) ackBraces = true;
+  else if (seq >= 0 && numAcks < 8) ackSeqs[numAcks++] = seq;
+  if (pos == target) doorStopped(); // Already there, ACK straight away
 }
 
-void closeDoor() {
-  if (pos == openPos) {
-    Serial.println("Closing door");
-    for (pos = openPos; pos > closePos; pos -= 1) { // closes door in 1degree steps
-      myservo.write(pos);
-      delay(50); // delay so it doesnt move too quick
-    }
+void moveDoor() {
+  if (pos == target) return;
+  if (millis() - lastStep < (unsigned long)stepDelay) return;
+  lastStep = millis();
+  pos += (pos < target) ? 1 : -1; // moves door in 1degree steps
+  myservo.write(pos);
+  if (pos == target) doorStopped();
+}
+
+void doorStopped() {
+  if (target == openPos) {
+    digitalWrite(LED_PIN, LOW); // Turn off light when door open
+    Serial.println("Door is now open");
+  } else {
     digitalWrite(LED_PIN, HIGH); // Turn on light when door closed
+    Serial.println("Door is now closed");
   }
-  Serial.println("Door is now closed");
-  Serial.println("{close}"); // ACK message to let Python know command was executed
-  Serial.flush();
+  if (ackBraces) returnState(); // ACK message to let Python know command was executed
+  for (int i = 0; i < numAcks; i++) sendFrame(ackSeqs[i], doorState());
+  ackBraces = false;
+  numAcks = 0;
+  Serial.flush(); // Wait for serial data to be sent before continuing
 }
 
 void TestLoop() {
     // This is used for testing. It opens and closes the door ever 5 seconds
-  openDoor();
-  delay(5000);
-  closeDoor();
-  delay(5000);
+  static unsigned long stopped = 0;
+  if (pos != target) {
+    stopped = millis();
+    return;
+  }
+  if (millis() - stopped >= 5000) moveTo((target == openPos) ? closePos : openPos, -2); // -2, nobody to ACK
 }
-
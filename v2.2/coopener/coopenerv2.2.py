@@ -61,24 +61,51 @@
 # v2.1 & v2.2
 # - Fixed comms between coopener and smarthome to send more info and cleaned up code a little
 # - Using CSS to show a nicer interface for user
+# - Door actions are kept in a scheduler which sleeps until the next one is due, instead of waking every 5 seconds
+# - Door actions are worked out again if the system time is stepped (eg. by NTP after booting with no RTC)
+# - kill -TERM, -HUP or -USR1 shuts down, reloads or refreshes the open/close times straight away
+# - Civil twilight times are calculated on the Pi (NOAA solar equations), so no internet is needed to get them.
+#   Set twilightSource = "api" to keep using api.sunrise-sunset.org, with the calculation as the fallback
+# - --build_table YEARS works out the twilight times for whole years at once (NumPy) and saves them to a table,
+#   so each day just looks the times up
+# - More than one door can be run from a single thread (see moreDoors at the bottom of the script)
+# - HTTP connections to SmartHome are kept open and reused, and all HTTP requests time out
+# - Heartbeats only send what changed since the last one (or just a sequence number if nothing did)
+# - A thread per serial port reads everything the Arduino sends, so replies are picked up as soon as they arrive
+# - Framed serial protocol with request IDs and a CRC, used if the Arduino supports it (Arduino alpha1.2)
+# - Writes to the Arduino are queued by priority, so door commands never wait behind chatter or each other
+# - SmartHome can queue flip/reconnect for us, they come back in the answer to our next heartbeat. So SmartHome
+#   doesn't need to be able to reach the Pi
+# - bulkBeats = True sends the heartbeats of all the doors in moreDoors to SmartHome in one request
+# - Commands to our /command go on a queue and are carried out straight away, in order, by their own thread
+# - /command?cmd=flip&wait=N waits (up to N seconds) for the Arduino's ACK, then answers with the door state and
+#   how long the serial round trip took
+# - /status answers with the door state, times, countdowns and link health without talking to the Arduino
+# - Door.getStatus() only asks the Arduino if what we know is older than statusTtl. ACKs and the Arduino's own
+#   {open}/{close} keep what we know up to date
+# - listener = "stdlib" answers SmartHome with Python's own threaded HTTP server, so Flask isn't needed.
+#   listener = "flask" still uses Flask
 #
 #
 #
 
 
 
-import json, os, re, serial, time, logging, argparse, sys, socket
+import json, os, re, serial, time, logging, argparse, sys, socket, heapq, signal, math, mmap, struct, calendar
 from logging.handlers import RotatingFileHandler
 from os import path
 from datetime import date
 from datetime import time
 from datetime import datetime
 from datetime import timedelta
-from time import sleep
-from urllib.request import urlopen
+from time import sleep, monotonic
 from threading import Thread
+from collections import deque
 import threading
 import urllib.request
+import urllib.parse
+import http.client
+import queue
 
 ###### Look at bottom of script for more configuration options ######
 
@@ -94,42 +121,48 @@ scriptLog = logging.getLogger('root')
 scriptLog.setLevel(logging.DEBUG)
 scriptLog.addHandler(myHandler)
 
-def main(latitude, longitude, script, url, port, myport, serialName="/dev/ttyAMA0", name="Coopener", filename="times.txt"):
+def main(latitude, longitude, script, url, port, myport, serialName="/dev/ttyAMA0", name="Coopener", filename="times.txt",
+         twilightSource="offline", tablefile=None):
   '''
     This is a loop within a loop. Outer loop is run once per day, at around 1am
-    Inner loop runs every few minutes and counts down until an action is to be taken (ie. open or close door)
+    Inner loop sleeps until the scheduler says an action is due (ie. open or close door) then takes it
     This script is designed to run forver.
   '''
 
-  if getProcess(os.path.basename(script)): exit() # If the script is already running, then exit
-
   args = parseArgs() # Parse cmd line args. Show help & quit if invalid args.
 
+  if args.build_table: # Work out the twilight table then exit. Can be done while another instance is running
+    if tablefile == None: sys.exit("No tablefile configured. Exiting.")
+    buildTwilightTable(tablefile, float(latitude), float(longitude), date.today().year, args.build_table)
+    sys.exit("Twilight table for " + str(args.build_table) + " year(s) written to " + tablefile + ". Exiting.")
+
+  if getProcess(os.path.basename(script)): exit() # If the script is already running, then exit
+
   scriptLog.info("****************************************************")
   scriptLog.info("*  Starting Coopener - www.makeitbreakitfixit.com")
   scriptLog.info("*  Thread instance name: " + name)
   scriptLog.info("****************************************************")
 
-  try:
-    ser = serial.Serial(
-      port=serialName,
-      baudrate = 9600,
-      parity=serial.PARITY_NONE,
-      stopbits=serial.STOPBITS_ONE,
-      bytesize=serial.EIGHTBITS,
-      timeout=1
-    )
-    ser.close()
-    ser.open()
-  except:
-    scriptLog.exception("Critical failure: Serial problem. Exiting.")
+  scheduler = Scheduler() # Holds the actions still to come today, soonest first. See Scheduler class at bottom of script
+  addScheduler(scheduler) # Lets the signal handlers wake us up for a shutdown, reload or refresh. Done before the
+                          # serial setup, which can take minutes if the Arduino doesn't answer
+
+  ser = openSerial(serialName)
+  if ser == None:
+    scriptLog.error("Critical failure: Serial problem. Exiting.")
     sys.exit("Exiting due to error. Check log")
 
   firstRun = True # When the script first starts we use this to set initial door position according to the time,
                   # unless the user specifies a position for the door during execution
-  door = Door(serial=ser) # Create a door object. Object defintions are at bottom of the script
+  link = SerialLink(ser, name) # Reads everything the Arduino sends in the background. See SerialLink class at bottom of script
+  door = Door(serial=link, name=name) # Create a door object. Object defintions are at bottom of the script
+  if scheduler.pending("shutdown"): # Asked to stop while we were setting up
+    scriptLog.info("Shutting down " + name + ".")
+    return
+  reportInterval = 600 # Number of seconds between telling the log and Arduino how long until the next action
+  clockInterval = 30 # Number of seconds between checks that the system time hasn't been stepped. See Scheduler.clockStep()
   
-  doorThread = Thread(target=doorWatch, args=(door, url, port, myport)) # This is a separate thread which monitors for HTTP comms from SmartHome
+  doorThread = Thread(target=doorWatch, args=(door, url, port, myport), daemon=True) # This is a separate thread which monitors for HTTP comms from SmartHome
   doorThread.start() # Begin the thread and let it run parallel to the main program. See bottom of this script for more info.
   
   if args.open:
@@ -145,18 +178,16 @@ def main(latitude, longitude, script, url, port, myport, serialName="/dev/ttyAMA
     door.flipStatus()
     sys.exit("Flip mode completed successfully. Door is now " + door.getStatus() + ". Exiting.")
 
-  url = "http://api.sunrise-sunset.org/json?lat=" + latitude + "&lng=" + longitude + "&formatted=0" # Prepare full URI to grab unsanitised times
+  table = None
+  if tablefile != None:
+    table = openTwilightTable(tablefile) # Precomputed twilight times (see buildTwilightTable()). None if not usable
 
 ############################# OUTSIDE LOOP - Runs once per day (before sunrise) #############################
   while(True): # This should loop once a day  
-    times = getTimes(url)
-    if times == None: # Something went wrong with getting times from the internet, try getting times from file
-      times = openFile(filename)
-      if times == None: # Something went wrong with opening the file
-        scriptLog.error("Critical failure: Cannot get times to open/close the door. Exiting.")
-        sys.exit("Exiting due to error. Check log")
-    else: # Successfully retrieved local times, now write them to file
-      writeFile(filename, times)
+    times = getTwilightTimes(latitude, longitude, filename, twilightSource, table)
+    if times == None: # Something went wrong with opening the file
+      scriptLog.error("Critical failure: Cannot get times to open/close the door. Exiting.")
+      sys.exit("Exiting due to error. Check log")
     scriptLog.info("\nRetrieved Times: " + str(times[0]) + " " + str(times[1]) + "\nInitialisation complete, beginning timers...\n")
 
     # Getting times was successful. Now we compare current time with open/close times
@@ -167,122 +198,200 @@ def main(latitude, longitude, script, url, port, myport, serialName="/dev/ttyAMA
       openTime = door.setOpenTime(args.open_time)
       closeTime = door.setCloseTime(args.close_time)
 
-    today = True # While it is today, keep looping
-    loopCount = 0
-############################# INSIDE LOOP - Runs ever few secs until end of day #############################
-    while (today): # This loop will keep running until both open and close signals have been sent, then script quits
-      now = datetime.now() # get current time
-      timeLeft2Open = door.getOpenTimeLeft() # number of seconds until door open
-      timeLeft2Close = door.getCloseTimeLeft() # number of seconds until door close
-
-      if now > openTime and now > closeTime:
-        # How embarrassing, this piece of code is only here in the extremely unlikely event that the script is
-        # started after sunset. This will close the door and avoid any further actions.
-        firstRun = False
+    now = datetime.now() # get current time
+    if now > openTime and now > closeTime:
+      # How embarrassing, this piece of code is only here in the extremely unlikely event that the script is
+      # started after sunset. This will close the door and avoid any further actions.
+      firstRun = False
+      door.setStatus("close")
+    if firstRun: # If this is the first time script is running, we should set the door in correct position
+      if now > openTime: # Door should already be opened, next action is to close
+        door.setStatus("open")
+        scriptLog.info("Setting state of door to open.")
+      elif now > closeTime: # Door should already be closed, next action is to open
         door.setStatus("close")
-
-      # Decide what the next action should be. Open or close.
-      #firstRun = nextAction(firstRun) # Returns what the next action should be. Also sets initiate state of door.
-      if now > openTime: # Door already opened, next action is to close
-        timeLeft = timeLeft2Close
-        action = "close"
-        if firstRun:
-          door.setStatus("open") # If this is the first time script is running, we should set the door in correct position
-          scriptLog.info("Setting state of door to open.")
-          firstRun = False # This should only happen once
-      elif now > closeTime: # Door already closed, next action is to open
-        timeLeft = timeLeft2Open
-        action = "open"
-        if firstRun:
-            door.setStatus("close")
-            scriptLog.info("Setting state of door to closed.")
-            firstRun = False
-      elif timeLeft2Open < timeLeft2Close: # Next action is to open
-        timeLeft = timeLeft2Open
-        action = "open"
-      elif timeLeft2Close < timeLeft2Open: # Next action is to close
-        timeLeft = timeLeft2Close
-        action = "close"
-
-      # The Arduino is using the serial line for outputting its status etc. Much of this is white noise.
-      # We also want the flexibility of Python to send some non-critical/arbitrary data to the Arduino.
-      # For this reason, all actual actionable commands (ie. open/close door) are placed inside
-      # curly braces { }. The maximum number of chars to send/receive inside the braces is 8.
-      # This particular project is very simple, but the aim here is to reuse this basic framework for
-      # other projects.
-      if ((loopCount % 120) == 0): # This is used to to only write to the log file and Arduino periodically
-                                  # instead of every interation of the loop. Increase mod number for longer gaps
-        scriptLog.info("Time left to " + action + " door: " + str(timeLeft)) # Tell Linux
-        ser.write(bytes("Time left to " + action + " door: " + str(timeLeft), 'UTF-8')) # Tell Arduino
-      loopCount = loopCount + 1 # Increment loop counter.
-      if timeLeft < timedelta(seconds=10) and timeLeft > timedelta(seconds=1): # Send signal to Arduino
+        scriptLog.info("Setting state of door to closed.")
+      firstRun = False # This should only happen once
+
+    # Hand the actions still to come today to the scheduler. It sleeps until exactly when the next one is due,
+    # instead of us waking every few seconds to check whether it is time yet.
+    for action in ("open", "close", "report", "clock", "refresh"): # Anything left from the day before. A shutdown
+      scheduler.remove(action)                                     # or reload asked for meanwhile stays, and is done next
+    if now < openTime: scheduler.add(openTime, "open")
+    if now < closeTime: scheduler.add(closeTime, "close")
+    scheduler.addIn(0, "report") # Tell Linux and Arduino how long until the next action straight away
+    scheduler.addIn(clockInterval, "clock")
+############################# INSIDE LOOP - Runs once per scheduled action until end of day #############################
+    reason = None # Set if we are interrupted before the day is finished (see interruptSchedulers())
+    while scheduler.pending("open", "close"): # Keep going until both open and close signals have been sent
+      action = scheduler.next() # Blocks until the next action is due
+      if action in interrupts:
+        reason = action
+        break
+      step = scheduler.clockStep() # Checked every time we wake, before doing anything at what may be the wrong time
+      if step: # Today's actions are due at the wrong time now. Work them out again, and put the door right
+        scriptLog.warning("System time has moved by " + str(int(step)) + " seconds (eg. NTP). Planning the day again.")
+        firstRun = True
+        reason = "reload"
+        break
+      if action == "clock":
+        scheduler.addIn(clockInterval, "clock")
+      elif action == "report":
+        # The Arduino is using the serial line for outputting its status etc. Much of this is white noise.
+        # We also want the flexibility of Python to send some non-critical/arbitrary data to the Arduino.
+        # For this reason, all actual actionable commands (ie. open/close door) are placed inside
+        # curly braces { }. The maximum number of chars to send/receive inside the braces is 8.
+        # This particular project is very simple, but the aim here is to reuse this basic framework for
+        # other projects.
+        nextAction = scheduler.first("open", "close")
+        if nextAction == "open": timeLeft = door.getOpenTimeLeft()
+        else: timeLeft = door.getCloseTimeLeft()
+        scriptLog.info("Time left to " + nextAction + " door: " + str(timeLeft)) # Tell Linux
+        link.write("Time left to " + nextAction + " door: " + str(timeLeft)) # Tell Arduino
+        scheduler.addIn(reportInterval, "report") # Increase reportInterval for longer gaps
+      else: # Send signal to Arduino
         door.setStatus(action)
 
-      if now > openTime and now > closeTime: # Door has already been opened and closed today.
-      # Once both actions are performed in a day, we then wait until the next day
-      # where we get the new twilight times and start all over again
-        today = waitForNextDay() # Will only return once it is the next day
+    # Door has already been opened and closed today.
+    # Once both actions are performed in a day, we then wait until the next day
+    # where we get the new twilight times and start all over again
+    scheduler.remove("report")
+    scheduler.remove("clock")
+    if reason == None:
+      reason = waitForNextDay(scheduler) # Will only return once it is the next day, or we are interrupted
+    if reason == "shutdown":
+      scriptLog.info("Shutting down " + name + ".")
+      return
+    if reason != "refresh" or scheduler.pending("refresh"): # Not the usual 1am refresh
+      scriptLog.info("Received " + reason + ". Getting new times and starting the day over.")
+
+def runDoors(doors, script, url, port, myport, twilightSource="offline", bulkBeats=False):
+  '''
+    Same job as main(), but for more than one door at a time. doors is a list of dicts, one per door, with
+    the name, latitude, longitude, serialName, filename and tablefile of that door (like the configuration
+    at the bottom of this script). All the doors share one DoorRuntime, which runs them from a single loop.
+    With bulkBeats, the heartbeats of all the doors are sent to SmartHome together in one request.
+    Command line args (eg. --test) are only used by main().
+  '''
+  global doorRuntime
 
-      sleep(5) # Wait a little before looping again
+  if getProcess(os.path.basename(script)): exit() # If the script is already running, then exit
+
+  scriptLog.info("****************************************************")
+  scriptLog.info("*  Starting Coopener - www.makeitbreakitfixit.com")
+  scriptLog.info("*  Running doors: " + ", ".join(door['name'] for door in doors))
+  scriptLog.info("****************************************************")
+
+  doorRuntime = DoorRuntime(url, port, myport, twilightSource, bulkBeats=bulkBeats)
+  for door in doors:
+    doorRuntime.addDoor(door['name'], door['latitude'], door['longitude'], door['serialName'], door['filename'],
+                        door.get('tablefile'))
+  doorRuntime.run() # Only returns once we are asked to shut down
+  scriptLog.info("Shutting down doors.")
 
 ######################################
 
-def writeSerial(action, ser):
+def openSerial(serialName):
+  '''
+    Open the serial port used to talk to the Arduino. Returns None if it can't be opened
+  '''
+  try:
+    ser = serial.Serial(
+      port=serialName,
+      baudrate = 9600,
+      parity=serial.PARITY_NONE,
+      stopbits=serial.STOPBITS_ONE,
+      bytesize=serial.EIGHTBITS,
+      timeout=1
+    )
+    ser.close()
+    ser.open()
+  except:
+    scriptLog.exception("Serial problem with " + serialName)
+    return None
+  return ser
+
+def writeSerial(action, link):
   '''
     Commands are sent via serial to the Arduino. All actual actionable commands (ie. open/close door)
     are placed inside curly braces { }. The maximum number of chars to send/receive inside the braces
     is 8. This particular project is very simple, but the aim here is to reuse this basic framework for
     other projects.
+    link is the SerialLink for the Arduino, which picks the reply out of everything the Arduino sends.
+    If the Arduino understands the framed protocol (see makeFrame()) that is used instead of the braces.
   '''
   scriptLog.info("[Serial Comms] SENT command to " + action + " door.")
-  timeout = datetime.now() + timedelta(minutes=3) # loop timeout is 3 minutes from now
-  while True: # Keep sending the signal until we receive an ACK or timeout expires
-    ser.write(bytes("{" + action + "}", 'UTF-8')) # Send signal
-    sleep(.1) # Wait a little before reading serial
-    status = readSerial(ser) # Listen for acknowledgement
-    scriptLog.info("[Serial Comms] Waiting for reply from Arduino. RCVed: " + str(status))
-    if status != None: # If Ard hasn't sent anything back we get None. Otherwise, we got a response.
-      if status == action: # An ACK is rcv'd when the Arduino sends the same action back to Python
-        scriptLog.info("[Serial Comms] RCV ACK \'" + action + "\' from Arduino")
-      if action == "status": # The response back from Ard should be the status of the door
-        scriptLog.info("[Serial Comms] RCV Status \'" + status + "\' from Arduino")
-      ser.flushInput() # Flush the serial buffer
-      ser.flushOutput()
-      return status
-    if datetime.now() > timeout: # No ACK rcv'd. Timeout of loop anyway
-      scriptLog.warning("Command has been sent, but no ACK received from Arduino.")
-      break
-    sleep(1) # Wait a little before communicating again
-  return None # If execution gets here something went wrong
-
-def readSerial(ser):
-  '''
-    The Arduino is using the serial line for outputting its status etc. Much of this is white noise.
-    We also want the flexibility of Python to send some non-critical/arbitrary data to the Arduino.
-    For this reason, all actual actionable commands (ie. open/close door) are placed inside
-    curly braces { }. The maximum number of chars to send/receive inside the braces is 8.
-    This particular project is very simple, but the aim here is to reuse this basic framework for
-    other projects.
+  status = link.request(action) # Keeps sending the signal until we receive an ACK or timeout expires
+  if status == None: # No ACK rcv'd
+    scriptLog.warning("Command has been sent, but no ACK received from Arduino.")
+    return None # If execution gets here something went wrong
+  if action == "status": # The response back from Ard should be the status of the door
+    scriptLog.info("[Serial Comms] RCV Status \'" + status + "\' from Arduino")
+  else: # An ACK is rcv'd when the Arduino sends the same action back to Python
+    scriptLog.info("[Serial Comms] RCV ACK \'" + action + "\' from Arduino")
+  return status
+
+def makeFrame(seq, command):
+  '''
+    Framed protocol (version 1), used instead of { } when the Arduino supports it (see SerialLink.negotiate()).
+    A frame looks like [1:0a:open*5c]. 1 is the protocol version, 0a is the request ID (sequence number, 2 hex
+    digits) and 5c is the CRC-8 (2 hex digits) of everything between [ and *. The Arduino answers with a frame
+    with the same request ID, so more than one command can be waiting on an answer at once. It answers "err"
+    if the CRC doesn't match, so we can send again straight away.
   '''
-  while (ser.inWaiting() > 1): # Loop until no more bytes left in serial input buffer
-    line = ser.readline().decode('utf-8').strip() # Read a whole line from Ard (ends in \r\n), decode it to a str. Strip newline chars
-    if len(line) > 1 and line[0] == '{' and line[-1] == '}': # Only keep it if it inside { }
-      status = line[1:-1] # Remove the curly braces (first and last char) from the string
-      return status
-  return None
+  body = "1:" + format(seq, "02x") + ":" + command
+  return "[" + body + "*" + format(crc8(body), "02x") + "]"
 
+def parseFrame(line):
+  '''
+    Opposite of makeFrame(). Takes a line (eg. [1:0a:open*5c]) and returns the request ID and what is in it,
+    or None if it isn't a frame or is corrupt
+  '''
+  match = re.search("^\\[(1:([0-9a-f]{2}):([^*\\]]*))\\*([0-9a-f]{2})\\]$", line)
+  if not match or crc8(match.group(1)) != int(match.group(4), 16):
+    return None
+  return int(match.group(2), 16), match.group(3)
+
+def crc8(text):
+  '''
+    CRC-8 (polynomial 0x07) of a string. Same as crc8() on the Arduino
+  '''
+  crc = 0
+  for byte in bytes(text, 'UTF-8'):
+    crc = crc ^ byte
+    for bit in range(8):
+      if crc & 0x80: crc = ((crc << 1) ^ 0x07) & 0xff
+      else: crc = (crc << 1) & 0xff
+  return crc
+
+def getTwilightTimes(latitude, longitude, filename, twilightSource="offline", table=None):
+  """
+    Get today's open/close times from wherever we can, in this order: the twilight table (if we have one),
+    the website (if twilightSource is "api"), working them out ourselves, then the file we saved them to last time.
+    Returns None if all of those failed
+  """
+  times = None
+  if table != None: # Just look today up in the table if we have one
+    times = getTimesFromTable(table, latitude, longitude, date.today())
+  if times == None and twilightSource == "api": # Grab the times from the website first
+    times = getTimes("http://api.sunrise-sunset.org/json?lat=" + latitude + "&lng=" + longitude + "&formatted=0")
+  if times == None: # Either we work them out ourselves anyway, or something went wrong with getting times from the internet
+    times = getTimesOffline(latitude, longitude)
+  if times == None: # Something went wrong with calculating times too (eg. no twilight today), try getting times from file
+    times = openFile(filename)
+  else: # Successfully retrieved local times, now write them to file
+    writeFile(filename, times)
+  return times
 
 def getTimes(urlData):
   """
     Connect to website and grab the full raw data for your location
   """
   try:
-    with urlopen(urlData) as url:
-      if (url.getcode() == 200): # if HTTP 200 OK returned
-        data = url.read().decode('utf-8') # read in contents of the webpage. Needs to be decoded to utf-8 for Python3
-      else:
-        scriptLog.warning("Error reading website to get times. HTTP Return Code: " + str(url.getcode()))
-        return None
+    code, data = httpClient.request(urlData) # read in contents of the webpage, already decoded to utf-8
+    if (code != 200): # if HTTP 200 OK not returned
+      scriptLog.warning("Error reading website to get times. HTTP Return Code: " + str(code))
+      return None
   except:
     scriptLog.warning("Problem retrieving data from " + urlData)
     return None
@@ -310,6 +419,173 @@ def parseResults(data):
   scriptLog.info("Retrieved raw data from URL: " + str(times))
   return times
 
+def getTimesOffline(latitude, longitude):
+  """
+    Work out today's civil twilight times ourselves, without going to the internet.
+    Gives back the same sanitised (local) times as getTimes() does
+  """
+  rawTimes = calcTwilight(float(latitude), float(longitude), date.today())
+  if rawTimes != None:
+    scriptLog.info("Calculated raw civil twilight times: " + str(rawTimes))
+    return parseData(rawTimes) # Same format as the website gives, so same parsing
+  else:
+    scriptLog.warning("Sun does not reach civil twilight at this location today. Cannot calculate times")
+    return None
+
+def calcTwilight(latitude, longitude, day):
+  """
+    Calculate civil twilight (sun 6 degrees below the horizon) for a local date, using the NOAA solar
+    position equations (https://www.esrl.noaa.gov/gmd/grad/solcalc/calcdetails.html).
+    Returns the UTC+0 begin and end times as a tuple of strings in the same format as
+    api.sunrise-sunset.org (eg. 2016-10-24T18:37:02+00:00), or None if the sun never gets that
+    high or that low (near the poles).
+  """
+  midnight = datetime(day.year, day.month, day.day) # Times below are minutes after midnight UTC on this date
+  julianDay = day.toordinal() + 1721424.5 # Julian day at midnight UTC
+  begin = end = 720 - 4 * longitude # First guess is solar noon at this longitude, in minutes
+  for attempt in range(2): # Second pass recalculates the sun position at the first pass' answer, for accuracy
+    begin = twilightMinutes(julianDay + begin / 1440.0, latitude, longitude, -1)
+    end = twilightMinutes(julianDay + end / 1440.0, latitude, longitude, 1)
+    if begin == None or end == None: return None
+  times = ((midnight + timedelta(minutes=begin)).strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+           (midnight + timedelta(minutes=end)).strftime("%Y-%m-%dT%H:%M:%S+00:00"))
+  return times
+
+def twilightMinutes(julianDay, latitude, longitude, direction):
+  """
+    Minutes after midnight UTC (of the day julianDay falls on) that civil twilight begins (direction -1)
+    or ends (direction 1), using the position of the sun at julianDay. None if it doesn't happen
+  """
+  t = (julianDay - 2451545.0) / 36525.0 # Julian centuries since J2000
+  meanLong = (280.46646 + t * (36000.76983 + t * 0.0003032)) % 360 # Geometric mean longitude of the sun (degrees)
+  meanAnom = 357.52911 + t * (35999.05029 - 0.0001537 * t) # Geometric mean anomaly of the sun (degrees)
+  ecc = 0.016708634 - t * (0.000042037 + 0.0000001267 * t) # Eccentricity of earth's orbit
+  m = math.radians(meanAnom)
+  center = math.sin(m) * (1.914602 - t * (0.004817 + 0.000014 * t)) + \
+           math.sin(2 * m) * (0.019993 - 0.000101 * t) + math.sin(3 * m) * 0.000289
+  omega = math.radians(125.04 - 1934.136 * t)
+  appLong = math.radians(meanLong + center - 0.00569 - 0.00478 * math.sin(omega)) # Apparent longitude of the sun
+  obliq = 23 + (26 + (21.448 - t * (46.815 + t * (0.00059 - t * 0.001813))) / 60) / 60
+  obliq = math.radians(obliq + 0.00256 * math.cos(omega)) # Corrected obliquity of the ecliptic
+  decl = math.asin(math.sin(obliq) * math.sin(appLong)) # Declination of the sun
+  y = math.tan(obliq / 2) ** 2
+  l0 = math.radians(meanLong)
+  eqTime = 4 * math.degrees(y * math.sin(2 * l0) - 2 * ecc * math.sin(m) + 4 * ecc * y * math.sin(m) * math.cos(2 * l0) - \
+                            0.5 * y * y * math.sin(4 * l0) - 1.25 * ecc * ecc * math.sin(2 * m)) # Equation of time (minutes)
+  lat = math.radians(latitude)
+  cosHour = math.cos(math.radians(96)) / (math.cos(lat) * math.cos(decl)) - math.tan(lat) * math.tan(decl) # 90 + 6 degrees
+  if cosHour < -1 or cosHour > 1: return None # Sun never gets to 6 degrees below the horizon, or never rises above it
+  hourAngle = math.degrees(math.acos(cosHour))
+  noon = 720 - 4 * longitude - eqTime # Solar noon, minutes after midnight UTC
+  return noon + direction * 4 * hourAngle
+
+def buildTwilightTable(tablefile, latitude, longitude, firstYear, years=1):
+  """
+    Work out civil twilight for every day of one or more years in one go and save it to tablefile, so
+    main() only has to look the day up. This needs NumPy, so it can be run on another PC and the file
+    copied over to the Pi (reading the table doesn't need NumPy).
+    File layout (little endian): header of "TWLT", version, first year, number of years, latitude and
+    longitude, then 366 rows per year (one per day of the year, the last is unused in non-leap years).
+    Each row is two signed 16 bit numbers, the minutes after midnight UTC on that date that civil
+    twilight begins and ends, or -32768 if it doesn't happen that day.
+  """
+  import numpy as np
+
+  scriptLog.info("Building twilight table for " + str(years) + " year(s) from " + str(firstYear) + " in " + tablefile)
+  firstDays = np.array([date(firstYear + year, 1, 1).toordinal() for year in range(years)], dtype=np.float64)
+  leapYears = np.array([calendar.isleap(firstYear + year) for year in range(years)])
+  slots = np.arange(366) # Day of the year, starting from 0
+  julianDays = (firstDays[:, None] + slots[None, :]).ravel() + 1721424.5 # Julian day at midnight UTC, every day
+  begin = end = np.full(julianDays.shape, 720 - 4 * longitude) # First guess is solar noon, same as calcTwilight()
+  for attempt in range(2):
+    begin = twilightMinutesArray(np, julianDays + begin / 1440.0, latitude, longitude, -1)
+    end = twilightMinutesArray(np, julianDays + end / 1440.0, latitude, longitude, 1)
+  valid = ((slots[None, :] < 365) | leapYears[:, None]).ravel() & ~np.isnan(begin) & ~np.isnan(end)
+  rows = np.empty((julianDays.size, 2), dtype="<i2")
+  rows[:, 0] = np.where(valid, np.floor(np.nan_to_num(begin)), twilightTableMissing) # Whole minutes, like the website
+  rows[:, 1] = np.where(valid, np.floor(np.nan_to_num(end)), twilightTableMissing)
+  try:
+    file = open(tablefile, "wb")
+    file.write(twilightTableHeader.pack(b"TWLT", 1, firstYear, years, latitude, longitude))
+    file.write(rows.tobytes())
+    file.close()
+  except:
+    scriptLog.warning("Problem writing " + tablefile + ". Check permissions and if disk is rw")
+
+def twilightMinutesArray(np, julianDays, latitude, longitude, direction):
+  """
+    Same as twilightMinutes(), but for a whole NumPy array of julian days at once. NaN where civil
+    twilight doesn't happen
+  """
+  t = (julianDays - 2451545.0) / 36525.0
+  meanLong = (280.46646 + t * (36000.76983 + t * 0.0003032)) % 360
+  m = np.radians(357.52911 + t * (35999.05029 - 0.0001537 * t))
+  ecc = 0.016708634 - t * (0.000042037 + 0.0000001267 * t)
+  center = np.sin(m) * (1.914602 - t * (0.004817 + 0.000014 * t)) + \
+           np.sin(2 * m) * (0.019993 - 0.000101 * t) + np.sin(3 * m) * 0.000289
+  omega = np.radians(125.04 - 1934.136 * t)
+  appLong = np.radians(meanLong + center - 0.00569 - 0.00478 * np.sin(omega))
+  obliq = 23 + (26 + (21.448 - t * (46.815 + t * (0.00059 - t * 0.001813))) / 60) / 60
+  obliq = np.radians(obliq + 0.00256 * np.cos(omega))
+  decl = np.arcsin(np.sin(obliq) * np.sin(appLong))
+  y = np.tan(obliq / 2) ** 2
+  l0 = np.radians(meanLong)
+  eqTime = 4 * np.degrees(y * np.sin(2 * l0) - 2 * ecc * np.sin(m) + 4 * ecc * y * np.sin(m) * np.cos(2 * l0) - \
+                          0.5 * y * y * np.sin(4 * l0) - 1.25 * ecc * ecc * np.sin(2 * m))
+  lat = np.radians(latitude)
+  cosHour = np.cos(np.radians(96)) / (np.cos(lat) * np.cos(decl)) - np.tan(lat) * np.tan(decl)
+  hourAngle = np.degrees(np.arccos(np.where(np.abs(cosHour) <= 1, cosHour, np.nan)))
+  noon = 720 - 4 * longitude - eqTime
+  return noon + direction * 4 * hourAngle
+
+def openTwilightTable(tablefile):
+  """
+    Memory map the table written by buildTwilightTable(). Returns None if it is missing or not valid
+  """
+  if not path.exists(tablefile):
+    scriptLog.warning("Twilight table " + tablefile + " doesnt exist. Run with --build_table to create it")
+    return None
+  try:
+    file = open(tablefile, "rb")
+    table = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    file.close() # The map stays open after the file is closed
+    magic, version, firstYear, years, latitude, longitude = twilightTableHeader.unpack_from(table)
+  except:
+    scriptLog.warning("Problem reading twilight table " + tablefile)
+    return None
+  if magic != b"TWLT" or version != 1 or len(table) != twilightTableHeader.size + years * 366 * twilightTableRow.size:
+    scriptLog.warning("Twilight table " + tablefile + " is corrupt or from a different version. Ignoring it")
+    return None
+  scriptLog.info("Using twilight table " + tablefile + " for " + str(years) + " year(s) from " + str(firstYear))
+  return table
+
+def getTimesFromTable(table, latitude, longitude, day):
+  """
+    Look the day up in a table opened with openTwilightTable(). Gives back the same sanitised (local)
+    times as getTimes() does, or None if the table doesn't have them
+  """
+  magic, version, firstYear, years, tableLat, tableLong = twilightTableHeader.unpack_from(table)
+  if abs(tableLat - float(latitude)) > 0.01 or abs(tableLong - float(longitude)) > 0.01:
+    scriptLog.warning("Twilight table is for a different location (" + str(tableLat) + ", " + str(tableLong) + ")")
+    return None
+  index = (day.year - firstYear) * 366 + day.timetuple().tm_yday - 1 # Row for this day of the year
+  if index < 0 or index >= years * 366:
+    scriptLog.warning("Twilight table doesn't cover " + str(day) + ". Run with --build_table to update it")
+    return None
+  begin, end = twilightTableRow.unpack_from(table, twilightTableHeader.size + index * twilightTableRow.size)
+  if begin == twilightTableMissing or end == twilightTableMissing:
+    scriptLog.warning("No civil twilight in the table for " + str(day))
+    return None
+  midnight = datetime(day.year, day.month, day.day)
+  rawTimes = ((midnight + timedelta(minutes=begin)).strftime("%Y-%m-%dT%H:%M:%S+00:00"),
+              (midnight + timedelta(minutes=end)).strftime("%Y-%m-%dT%H:%M:%S+00:00"))
+  scriptLog.info("Retrieved raw times from twilight table: " + str(rawTimes))
+  return parseData(rawTimes) # Same format as the website gives, so same parsing
+
+twilightTableHeader = struct.Struct("<4sHHHdd") # "TWLT", version, first year, number of years, latitude, longitude
+twilightTableRow = struct.Struct("<hh") # Civil twilight begin and end, minutes after midnight UTC
+twilightTableMissing = -32768 # Stored instead of minutes on days without civil twilight
+
 # Parse the raw civil twilight hours to something we can use in this script
 def parseData(data):
   pattern = "T([0-2][0-9]:[0-5][0-9]):[0-9][0-9][\+\-]" # Regex search pattern to grab the time
@@ -480,6 +756,12 @@ def parseArgs():
                       type=int,
                       help="Must be used with --test and --open_time options. Specifies how many seconds to wait until door is closed"
                       )
+  parser.add_argument("--build_table",
+                      type=int,
+                      metavar="YEARS",
+                      help="Work out the civil twilight times for this many years (starting this year), save them to the twilight\
+                      table file then exit. Needs NumPy"
+                      )
   parser.add_argument("-f", "--flip",
                       help="Flip the door status. This will open the door if already closed or close if already opened. Once finished, the\
                       script will exit",
@@ -517,33 +799,23 @@ def parseArgs():
   #print(vars(args)) # convert args from object to a dict 
   return args
 
-def waitForNextDay():
+def waitForNextDay(scheduler):
   '''
     In here we just wait for the next day (at 1am) then exit the loop.
-    When exiting the loop we return False, which will trigger the whole script to start over
-    (ie. get new twilight hours and write to file etc...)
+    When exiting the loop we return why we stopped waiting, which will trigger the whole script to start over
+    (ie. get new twilight hours and write to file etc...), or stop it if it was a shutdown.
+    Returns "refresh" at 1am, or straight away with "shutdown", "reload" or "refresh" if one of those
+    is asked for earlier (see interruptSchedulers()).
   '''
   scriptLog.info("No more actions left to do today, will go to sleep until tomorrow")
-  # There HAS to be an easier way to do the below, but this works and I cant be bothered finding a nicer way
-  # below few lines will build two time objects and subtract them from each other to get a countdown timer
-  eta = datetime.now() + timedelta(days=1) # First, build a datetime object which is right now plus 1 day
-  eta = eta.strftime("%Y-%m-%d 01:00:00.0") # Return string representation of the object but at 1am
-  eta = datetime.strptime(eta, "%Y-%m-%d %H:%M:%S.%f") # This takes a string of date/time and turns it in to an object
-  # So what is happened above is: 1) get current datetime and add 1 day. 2) Manipulate the result of #1 so it shows 1am
-  # and return it as a string. 3) Using a datetime string, turn it back in to an object which can be used to subtract
-  # from other datetime objects.
-  loopCount = 0
-  while (True): # Now we wait until it is 1am on the next day
-    now = datetime.now()
-    counter = eta - now
-    if ((loopCount % 120) == 0): # This is used to to only write to the log file and Arduino periodically
-                                  # instead of every interation of the loop. Increase mod number for longer gaps
-      scriptLog.info("Sleeping " + str(counter.total_seconds()) + " seconds until restarting script")
-    loopCount = loopCount + 1
-    if int(counter.total_seconds()) < 60: # Not long left until 1am next day
-      return False # Exit loop
-    sleep(5) # Wait for a few minutes before checking again
-  
+  eta = datetime.combine(date.today() + timedelta(days=1), time(1, 0)) # 1am tomorrow
+  deadline = scheduler.add(eta, "refresh")
+  scriptLog.info("Sleeping " + str(int(deadline - monotonic())) + " seconds until restarting script")
+  while (True): # Now we wait until it is 1am on the next day. Nothing else should be scheduled overnight,
+    action = scheduler.next() # but skip over it if it is
+    if action in interrupts:
+      return action # Exit loop. If woken early, the 1am refresh is still pending but it is cleared on the way round
+
 def get_ip_address(): # This will open a socket so we can get the IP address of the RasPi.
 # It doesnt actually need to make a connection or do anything with the socket.
 # Returns this devices IP.
@@ -562,57 +834,113 @@ class Door(object):
     needed. But this is just for future-proofing the project as there may be a 
     chance that we will want to control multiple doors at some stage.
   '''
-  def __init__(self, serial):
-    self.ser = serial
-    self.status = self.getStatus()
+  def __init__(self, serial, name="Coopener", statusTtl=60):
+    self.ser = serial # SerialLink to the Arduino
+    self.name = name # Name of the coopener instance. Tells SmartHome which door it is talking to
+    self.ack = None # What the Arduino answered the last open/close with. None if it didn't
+    self.rtt = None # Seconds from sending the last open/close to the Arduino until it answered (or we gave up)
+    self.status = None
+    self.statusTtl = statusTtl # Seconds the Arduino's answer to status is trusted for. See getStatus()
+    self.statusAt = None # time.monotonic() when the Arduino last told us the state. None if we aren't sure of it
     self.connect = False
     self.openTime = 0
     self.closeTime = 0
+    self.snapshot = {} # The door as /status shows it. See publish()
+    self.moving = threading.RLock() # Held while the door is being opened or closed. See setStatus()
+    if serial != None: serial.onState = self.heard # The Arduino telling us where the door is, asked or not
+    self.status = self.getStatus("force")
+    self.missedBeats = 0 # Number of heartbeats in a row SmartHome hasn't answered
+    self.beatSeq = 0 # Sequence number of the last heartbeat sent
+    self.sent = None # State SmartHome has from our heartbeats. None if it has nothing (send everything)
+    runningDoors[name] = self
+
+  def publish(self):
+    '''
+      Replaces snapshot with how the door is now. The snapshot is a new dict each time and never changed after, so
+      /status can read it without a lock. Called whenever the Arduino answers or the times or connection change
+    '''
+    self.snapshot = {'name': self.name, 'state': self.status, 'connected': self.connect,
+                     'openTime': self.openTime.timestamp() if isinstance(self.openTime, datetime) else None,
+                     'closeTime': self.closeTime.timestamp() if isinstance(self.closeTime, datetime) else None,
+                     'ack': self.ack, 'rtt': round(self.rtt, 3) if self.rtt != None else None,
+                     'updated': datetime.now().timestamp()}
 
   def setConnected(self, connected): # Sets state of the HTTP connection to SmartHome
     self.connect = connected
+    self.publish()
     return self.connect
 
   def getConnected(self): # Returns state of HTTP connection to SmartHome
     return self.connect
 
-  def setStatus(self, status): # open or close the door
-    writeSerial(status, self.ser)
-    self.status = status
-
-  def getStatus(self): # get state of the door. either open or close
+  def setStatus(self, status):
+    '''
+      open or close the door. One at a time: anything else wanting to move the door (the schedule, a flip from
+      SmartHome) waits until the Arduino has finished this, so commands are done in the order they were given
+      and the Arduino is never asked to go one way while it is still going the other
+    '''
+    with self.moving:
+      started = monotonic()
+      self.ack = writeSerial(status, self.ser)
+      self.rtt = monotonic() - started
+      self.status = self.ack if self.ack in ("open", "close") else status # Where the Arduino says it went
+      self.statusAt = monotonic() if self.ack in ("open", "close") else None # No ACK, so it needs asking next time
+      self.publish()
+
+  def getStatus(self, mode="auto"):
+    '''
+      Get state of the door. either open or close
+      mode "force" always asks the Arduino. "cached" never does, it returns what we last knew.
+      "auto" only asks if what we know is older than statusTtl seconds (or we aren't sure of it). What we know is
+      kept up to date by open/close ACKs and by the Arduino sending {open}/{close} on its own (see heard())
+    '''
+    if mode == "cached" or (mode == "auto" and self.statusAt != None and monotonic() - self.statusAt < self.statusTtl):
+      return self.status
     self.status = writeSerial("status", self.ser)
+    self.statusAt = monotonic()
     if (self.status == None):
       scriptLog.warning("No status returned from Arduino. Don't know if door is open or closed. Continuing...")
       self.status = "close" # Just assume it is closed. Meh. (fix this another time)
+      self.statusAt = None
+    self.publish()
     return self.status
 
   def getStatusNoArd(self): # This returns status of the door without talking to the Arduino
   # This is used for giving the status for the HTTP heartbeat protocol. Because I am lazy
-    return self.status
+    return self.getStatus("cached")
+
+  def heard(self, status): # Called by the SerialLink whenever the Arduino says the door is open or close
+    self.status = status
+    self.statusAt = monotonic()
+    self.publish()
 
   def flipStatus(self): # If door is opened, it'll close. If it's closed, it'll open
                       # If state is unknown (ie. at script start) nothing happens
-    if self.status == "open":
-      self.setStatus("close")
-      return self.status
-    if self.status == "close":
-      self.setStatus("open")
-      return self.status
+    with self.moving: # So the door can't move between us looking at it and flipping it
+      self.ack = None
+      self.rtt = None
+      if self.status == "open":
+        self.setStatus("close")
+        return self.status
+      if self.status == "close":
+        self.setStatus("open")
+        return self.status
 
   def calcOpenTime(self, times): # Receives the open/close times from either the net or
                     # from file, calculated what time door should open and returns it
     now = datetime.now() # Get current date and time
     # Build a complete date and time string for the open and close times
-    # Look in waitForNextDay() function for a detailed explanation of what is going on here
+    # First turn it in to a string of today's date with the time we got, then turn that string back in to an object
     self.openTime = now.strftime("%Y-%m-%d " + times[0][0] + times[0][1] + ":" + times[0][2] + times[0][3] + ":%S.%f") # Create string
     self.openTime = datetime.strptime(self.openTime, "%Y-%m-%d %H:%M:%S.%f") # Turn in to datetime object
+    self.publish()
     return self.openTime
 
   def calcCloseTime(self, times): # Same as getOpenTime() but for the close time
     now = datetime.now()
     self.closeTime = now.strftime("%Y-%m-%d " + times[1][0] + times[1][1] + ":" + times[1][2] + times[1][3] + ":%S.%f")
     self.closeTime = datetime.strptime(self.closeTime, "%Y-%m-%d %H:%M:%S.%f")
+    self.publish()
     return self.closeTime
 
   def getOpenTime(self):
@@ -623,10 +951,12 @@ class Door(object):
 
   def setOpenTime(self, newTime): # Used for overriding the opentime (eg. when testing)
     self.openTime = datetime.now() + timedelta(seconds=newTime)
+    self.publish()
     return self.openTime
 
   def setCloseTime(self, newTime):
     self.closeTime = datetime.now() + timedelta(seconds=newTime)
+    self.publish()
     return self.closeTime
 
   def getOpenTimeLeft(self): # Returns time left to open the door
@@ -649,133 +979,875 @@ class Door(object):
       return 0
     return int((self.closeTime - now).total_seconds())
 
+class Scheduler(object):
+  '''
+    Keeps a heap of pending actions, each keyed by the time.monotonic() deadline it is due at.
+    next() sleeps until the earliest deadline comes around and hands back that action, so nothing
+    wakes up just to find out there is nothing to do yet. Adding an action from another thread
+    wakes next() early so it can work out again which action is now first.
+    Deadlines are on the monotonic clock, so actions added with add() (a time of day) are due that many seconds
+    after they were added. If the system time is then stepped (eg. NTP setting the clock of a Pi that has no RTC,
+    after it started with the wrong time), they are off by as much. clockStep() notices that, so whoever added
+    them can work them out again.
+  '''
+  def __init__(self):
+    self.heap = [] # Entries are (deadline, sequence, action). Smallest deadline is always heap[0]
+    self.offset = None # System time minus time.monotonic() when add() was last used. See clockStep()
+    self.sequence = 0 # Keeps actions with the same deadline in the order they were added
+    self.cond = threading.Condition() # Used to sleep until a deadline, or be woken by a new action
+
+  def add(self, when, action): # Schedule an action for a datetime (local time). Returns its deadline
+    now = datetime.now().timestamp()
+    with self.cond:
+      self.offset = now - monotonic()
+    return self.addIn(when.timestamp() - now, action) # Not when - now, that is an hour out across a DST change
+
+  def clockStep(self, limit=5):
+    '''
+      Seconds the system time has been stepped by since add() was last used, if more than limit (otherwise 0).
+      Each step is only reported once
+    '''
+    with self.cond:
+      if self.offset == None:
+        return 0
+      step = datetime.now().timestamp() - monotonic() - self.offset
+      if abs(step) <= limit:
+        return 0
+      self.offset = self.offset + step
+      return step
+
+  def addIn(self, seconds, action): # Schedule an action a number of seconds from now. Returns its deadline
+    with self.cond:
+      deadline = monotonic() + max(seconds, 0)
+      heapq.heappush(self.heap, (deadline, self.sequence, action))
+      self.sequence = self.sequence + 1
+      self.cond.notify_all() # Wake next() in case this action is now the first one due
+    return deadline
+
+  def remove(self, action): # Drop all pending entries of an action
+    with self.cond:
+      self.heap = [entry for entry in self.heap if entry[2] != action]
+      heapq.heapify(self.heap)
+      self.cond.notify_all()
+
+  def clear(self): # Drop everything that is pending
+    with self.cond:
+      self.heap = []
+      self.cond.notify_all()
+
+  def pending(self, *actions): # True if any of the given actions are still waiting to happen
+    with self.cond:
+      return any(entry[2] in actions for entry in self.heap)
+
+  def first(self, *actions): # Returns whichever of the given actions is due soonest, or None
+    with self.cond:
+      due = [entry for entry in self.heap if entry[2] in actions]
+      if not due: return None
+      return min(due)[2]
+
+  def next(self): # Sleep until the first action is due, then remove it from the heap and return it
+    with self.cond:
+      while True:
+        if not self.heap:
+          self.cond.wait() # Nothing scheduled. Sleep until something is added
+          continue
+        wait = self.heap[0][0] - monotonic()
+        if wait <= 0:
+          return heapq.heappop(self.heap)[2]
+        self.cond.wait(wait) # Returns at the deadline, or early if the heap changed
+
+class DoorRuntime(object):
+  '''
+    Runs any number of doors from one thread, instead of a main() and doorWatch() thread for each door.
+    Every door's actions (start, refresh, open, close, flip, heartbeat, reconnect) go in one shared Scheduler
+    as (door name, action). run() sleeps until the next one is due and hands it to a worker, since talking
+    to the Arduino or SmartHome blocks.
+    Each door has two lanes of actions: "serial" ones (start, open, close, flip...) and "net" ones (heartbeat,
+    reconnect) which only talk to SmartHome, so a door waiting minutes for its Arduino keeps sending heartbeats.
+    Each lane's actions are done one at a time and in order. There is a worker for every lane of every door
+    (plus one for sendBeats()), started when the door is added and never stopped, so a door with a hung serial
+    port only ever holds up itself, however many doors are hung.
+    All doors share one HTTP client (httpClient).
+  '''
+  def __init__(self, url, port, myport, twilightSource="offline", beatInterval=10, bulkBeats=False):
+    self.url = url # SmartHome Server URL
+    self.port = port # Port SmartHome server is listening on
+    self.myport = myport # Port we are listening on for return comms
+    self.twilightSource = twilightSource
+    self.beatInterval = beatInterval # Seconds between heartbeats for each door
+    self.bulkBeats = bulkBeats # Send the heartbeats of every connected door together. See sendBeats()
+    self.scheduler = Scheduler()
+    addScheduler(self.scheduler) # Lets the signal handlers wake us up for a shutdown, reload or refresh
+    self.myip = None # WiFi IP of the RasPi, looked up on first handshake
+    self.configs = {} # Door name -> dict of latitude, longitude, serialName, filename, tablefile
+    self.doors = {} # Door name -> Door object, once the door has started
+    self.queues = {} # (door name, lane) -> actions due but not done yet
+    self.busy = set() # (door name, lane) of lanes which have a worker doing their actions
+    self.lock = threading.Lock() # Protects queues and busy
+    self.ready = queue.Queue() # (function, args) waiting for a worker. See workLoop()
+    self.addWorkers(1) # For sendBeats()
+
+  def addWorkers(self, count):
+    for i in range(count):
+      Thread(target=self.workLoop, daemon=True).start() # Daemon, so a hung door can't stop a shutdown
+
+  def addDoor(self, name, latitude, longitude, serialName, filename, tablefile=None):
+    self.configs[name] = {'latitude': latitude, 'longitude': longitude, 'serialName': serialName,
+                          'filename': filename, 'tablefile': tablefile}
+    self.queues[(name, "serial")] = deque()
+    self.queues[(name, "net")] = deque()
+    self.addWorkers(2) # One for each of its lanes, so it never waits for another door's worker
+    self.scheduler.addIn(0, (name, "start")) # Serial setup blocks, so it is done by a worker like everything else
+
+  def command(self, name, cmd, reply=None):
+    '''
+      Command from SmartHome for a door. Returns False if door or command is invalid.
+      If reply (a queue) is given, what happened (see commandResult()) is put on it once the command is done
+    '''
+    if name == None and len(self.configs) == 1: # Only one door, so it must be for that one
+      name = list(self.configs)[0]
+    if name not in self.configs or cmd not in ("flip", "reconnect"):
+      return False
+    if reply == None: self.scheduler.addIn(0, (name, cmd)) # Wakes run() straight away
+    else: self.dispatch(name, (cmd, reply)) # Straight to the door's worker, which answers reply when it is done
+    return True
+
+  def run(self): # Main loop. Only returns once we are asked to shut down
+    if self.bulkBeats: self.scheduler.addIn(self.beatInterval, "beats")
+    while True:
+      entry = self.scheduler.next() # Blocks until the next action for any door is due
+      step = self.scheduler.clockStep() # Checked every heartbeat or so
+      if step: # Every door's open/close is due at the wrong time now. Work them out again, and put the doors right
+        scriptLog.warning("System time has moved by " + str(int(step)) + " seconds (eg. NTP). Planning the day again.")
+        for name in list(self.doors):
+          self.dispatch(name, "replan")
+      if entry == "shutdown":
+        break
+      elif entry == "beats": # Heartbeats for all the doors. Talks to SmartHome, so not done here
+        self.ready.put((self.sendBeats, ()))
+      elif entry in interrupts: # Reload or refresh. Get new times for every door
+        for name in list(self.doors):
+          self.dispatch(name, "refresh")
+      else:
+        self.dispatch(*entry)
+
+  def dispatch(self, name, action): # Queue up an action for a door, and get a worker going on it if there isn't one
+    lane = (name, self.lane(action))
+    with self.lock:
+      if action in ("refresh", "replan", "heartbeat") and action in self.queues[lane]:
+        return # Already waiting to be done. No point doing it twice
+      self.queues[lane].append(action)
+      if lane in self.busy:
+        return # The worker already on this lane will get to it
+      self.busy.add(lane)
+    self.ready.put((self.work, lane))
+
+  def lane(self, action): # Which of a door's lanes an action goes in. See the class docstring
+    if isinstance(action, tuple): action = action[0] # (command, reply)
+    if action in ("heartbeat", "reconnect"): return "net"
+    return "serial"
+
+  def workLoop(self): # Each worker runs this for as long as the script runs
+    while True:
+      function, args = self.ready.get() # Sleeps until there is something to do
+      try:
+        function(*args)
+      except:
+        scriptLog.exception("Problem in DoorRuntime worker")
+
+  def work(self, name, lane): # Run by a worker. Does the actions queued in one of a door's lanes until there are none left
+    while True:
+      with self.lock:
+        if not self.queues[(name, lane)]:
+          self.busy.discard((name, lane))
+          return
+        action = self.queues[(name, lane)].popleft()
+      reply = None
+      if isinstance(action, tuple): action, reply = action # Someone is waiting to hear how it went
+      try:
+        self.doAction(name, action)
+      except:
+        scriptLog.exception("[" + name + "] Problem doing " + action)
+      if reply != None: reply.put(commandResult(self.doors.get(name), action))
+
+  def doAction(self, name, action):
+    door = self.doors.get(name)
+    if action == "start":
+      self.startDoor(name)
+    elif door == None: # Door didn't start (eg. serial problem). Nothing we can do for it
+      return
+    elif action == "refresh":
+      self.planDay(door)
+    elif action == "replan": # The system time has been stepped
+      self.planDay(door, firstRun=True)
+    elif action in ("open", "close"):
+      door.setStatus(action)
+    elif action == "flip":
+      scriptLog.info("[HTTP Comms] Flipped door " + name + " status to " + str(door.flipStatus()))
+    elif action == "reconnect":
+      scriptLog.info("[HTTP Comms] Received command to reconnect " + name + " to SmartHome server")
+      door.setConnected(False)
+      self.dispatch(name, "heartbeat") # Which handshakes, as we are no longer connected
+    elif action == "heartbeat":
+      self.scheduler.remove((name, "heartbeat")) # Only ever one heartbeat waiting per door
+      if door.getConnected() or self.connect(door):
+        if self.bulkBeats:
+          return # sendBeats() does this door's heartbeats now it is connected
+        for cmd in heartbeat(door, httpClient, self.url, self.port): # Commands SmartHome had waiting for this door
+          if cmd in ("flip", "reconnect"): self.dispatch(name, cmd)
+      if door.getConnected(): self.scheduler.addIn(self.beatInterval, (name, "heartbeat"))
+      else: self.scheduler.addIn(5, (name, "heartbeat")) # Wait before trying the handshake again
+
+  def sendBeats(self):
+    '''
+      The heartbeats of every connected door in one POST to SmartHome (/heartbeats), one per line, instead of
+      a request for each door. The answer has a line for each door. Doors that lose their connection go back
+      to handshaking on their own (the heartbeat action)
+    '''
+    try:
+      doors = [door for door in list(self.doors.values()) if door.getConnected()]
+      if not doors:
+        return
+      beats = [] # (door, query, state) for each door whose heartbeat could be made
+      for door in doors:
+        try:
+          beats.append((door,) + beatQuery(door))
+        except Exception as e: # eg. its times aren't known yet. Counts as a missed heartbeat for that door only
+          scriptLog.warning("[HTTP Comms] [" + door.name + "] Could not make heartbeat: " + repr(e))
+          beatAnswer(door, None, "")
+      answers = []
+      if beats:
+        try:
+          answers = httpClient.post(self.url + ":" + self.port + "/heartbeats", "\n".join(query for door, query, state in beats))
+          answers = answers.split("\n")
+        except Exception as e:
+          scriptLog.info("[HTTP Comms] Heartbeats for " + str(len(beats)) + " doors failed: " + str(e))
+      for i, (door, query, state) in enumerate(beats):
+        answer = answers[i] if i < len(answers) else ""
+        for cmd in beatAnswer(door, state, answer): # Commands SmartHome had waiting for this door
+          if cmd in ("flip", "reconnect"): self.dispatch(door.name, cmd)
+      for door in doors:
+        if not door.getConnected():
+          self.dispatch(door.name, "heartbeat") # Which handshakes
+    finally:
+      self.scheduler.addIn(self.beatInterval, "beats")
+
+  def connect(self, door): # Handshake with SmartHome for a door
+    if self.myip == None: self.myip = get_ip_address()
+    return handshake(door, httpClient, self.url, self.port, self.myport, self.myip)
+
+  def startDoor(self, name):
+    config = self.configs[name]
+    ser = openSerial(config['serialName'])
+    if ser == None:
+      scriptLog.error("[" + name + "] Serial problem. This door will not be run.")
+      return
+    door = Door(serial=SerialLink(ser, name), name=name)
+    door.table = None # Precomputed twilight times for this door's location, if there are any
+    if config['tablefile'] != None:
+      door.table = openTwilightTable(config['tablefile'])
+    self.doors[name] = door
+    self.planDay(door, firstRun=True)
+    self.scheduler.addIn(5, (name, "heartbeat")) # Give everything a moment, then connect to SmartHome
+
+  def planDay(self, door, firstRun=False):
+    '''
+      Does for one door what each pass of the outside loop in main() does. Gets today's times, sets
+      the door to the right position if we have just started, and schedules today's open and close
+      and tomorrow's refresh
+    '''
+    name = door.name
+    config = self.configs[name]
+    for action in ("open", "close", "refresh"): # Anything still pending is from the old times
+      self.scheduler.remove((name, action))
+    tomorrow = datetime.combine(date.today() + timedelta(days=1), time(1, 0)) # 1am tomorrow
+    times = getTwilightTimes(config['latitude'], config['longitude'], config['filename'], self.twilightSource, door.table)
+    if times == None:
+      scriptLog.error("[" + name + "] Cannot get times to open/close the door. Closing it and trying again in an hour.")
+      door.setStatus("close")
+      self.scheduler.addIn(3600, (name, "refresh"))
+      return
+    openTime = door.calcOpenTime(times)
+    closeTime = door.calcCloseTime(times)
+    now = datetime.now()
+    if now > openTime and now > closeTime: # Started (or refreshed) after sunset
+      door.setStatus("close")
+    elif firstRun and now > openTime: # Door should already be opened
+      door.setStatus("open")
+    elif firstRun and now > closeTime: # Door should already be closed
+      door.setStatus("close")
+    if now < openTime: self.scheduler.add(openTime, (name, "open"))
+    if now < closeTime: self.scheduler.add(closeTime, (name, "close"))
+    self.scheduler.add(tomorrow, (name, "refresh"))
+    scriptLog.info("[" + name + "] Retrieved Times: " + str(times[0]) + " " + str(times[1]))
+
+class HttpClient(object):
+  '''
+    Keeps HTTP connections open (keep-alive) and reuses them for the next request to the same server,
+    instead of opening a new TCP connection for every handshake, heartbeat and twilight lookup. That only
+    happens if the server allows it (SmartHome under Apache/mod_wsgi or webtool_async.py does, Flask's own
+    app.run() server doesn't), otherwise each request gets a new connection.
+    Every request has a connect timeout and a read timeout, so a slow server can't freeze the caller.
+    Safe to share between threads, each request gets a connection to itself.
+  '''
+  def __init__(self, connectTimeout=5, readTimeout=10, maxIdle=2):
+    self.connectTimeout = connectTimeout # Seconds to wait for the TCP connection to be made
+    self.readTimeout = readTimeout # Seconds to wait for the server to answer
+    self.maxIdle = maxIdle # Most connections kept open per server when they aren't being used
+    self.idle = {} # (scheme, host, port) -> connections not being used right now
+    self.lock = threading.Lock() # Protects idle
+
+  def get(self, url): # Returns the body of the page. Raises an exception if it fails or the server doesn't return 200 OK
+    code, body = self.request(url)
+    if code != 200:
+      raise IOError("HTTP " + str(code) + " returned from " + url)
+    return body
+
+  def post(self, url, data): # Same as get(), but POSTs data (a str) to the page
+    code, body = self.request(url, data)
+    if code != 200:
+      raise IOError("HTTP " + str(code) + " returned from " + url)
+    return body
+
+  def request(self, url, data=None): # Returns the HTTP status code and the body (decoded to utf-8). Raises an exception if it fails
+    parts = urllib.parse.urlsplit(url)
+    server = (parts.scheme, parts.hostname, parts.port)
+    page = parts.path or "/"
+    if parts.query: page = page + "?" + parts.query
+    while True:
+      conn, reused = self.checkout(server)
+      try:
+        if data == None: conn.request("GET", page)
+        else: conn.request("POST", page, body=data.encode("utf-8"), headers={'Content-Type': "text/plain; charset=utf-8"})
+        response = conn.getresponse()
+        body = response.read().decode("utf-8")
+      except (ConnectionError, http.client.BadStatusLine):
+        conn.close()
+        if reused: continue # Server closed the connection while it was idle. Try again on a new one
+        raise
+      except:
+        conn.close()
+        raise
+      if response.will_close: conn.close() # Server doesn't do keep-alive
+      else: self.checkin(server, conn)
+      return response.status, body
+
+  def checkout(self, server): # Get an idle connection to the server, or make a new one. Also returns if it was reused
+    with self.lock:
+      if self.idle.get(server):
+        return self.idle[server].pop(), True
+    scheme, host, port = server
+    if scheme == "https": conn = http.client.HTTPSConnection(host, port, timeout=self.connectTimeout)
+    else: conn = http.client.HTTPConnection(host, port, timeout=self.connectTimeout)
+    conn.connect()
+    conn.sock.settimeout(self.readTimeout) # Connected, from now on it is the read timeout
+    return conn, False
+
+  def checkin(self, server, conn): # Keep the connection for next time, unless we already have enough
+    with self.lock:
+      idle = self.idle.setdefault(server, [])
+      if len(idle) < self.maxIdle:
+        idle.append(conn)
+        return
+    conn.close()
+
+class SerialLink(object):
+  '''
+    Owns the serial port to one Arduino. The Arduino is using the serial line for outputting its status etc.
+    Much of this is white noise. For this reason, all actual actionable commands (ie. open/close door) are
+    placed inside curly braces { }.
+    A background thread reads every line the Arduino sends, as soon as it arrives. Frames ({...}) are kept
+    for whoever is waiting on a reply, everything else is just logged. Nothing is flushed, so no reply is lost.
+    At startup we ask the Arduino if it understands the framed protocol (see makeFrame()). If it does, that
+    is used for requests instead of braces, and answers are matched to requests by their request ID.
+    Only the writer thread writes to the port. Everything to send goes in a priority queue, door open/close
+    first, then status requests, then informational chatter. Chatter is sent in small pieces, so at most
+    one piece of it is ever in the way of a command.
+  '''
+  ACTUATE = 0 # Priorities for writing to the Arduino. Door open/close,
+  QUERY = 1 # status requests,
+  CHATTER = 2 # and anything informational (eg. "Time left to...")
+
+  def __init__(self, ser, name="Coopener", keep=32, chunk=16):
+    self.ser = ser
+    self.name = name # Name of the door on the other end. Used for logging
+    self.ser.timeout = None # The reader thread just blocks until there is a whole line
+    self.frames = deque(maxlen=keep) # (time received, frame) not taken by anyone yet. Oldest dropped once full
+    self.replies = {} # Request ID -> answer, for framed protocol answers not taken yet
+    self.protocol = 0 # Framed protocol version the Arduino understands. 0 means braces only
+    self.lastHeard = None # time.monotonic() when the Arduino last sent us anything
+    self.unanswered = 0 # Requests in a row the Arduino hasn't answered
+    self.onState = None # Called with "open" or "close" whenever the Arduino says where the door is
+    self.seq = 0 # Request ID of the last framed request sent
+    self.cond = threading.Condition() # Lets callers wait for a frame to arrive
+    self.chunk = chunk # Chatter is sent this many chars at a time
+    self.writes = queue.PriorityQueue() # (priority, order, bytes) waiting to be sent by the writer thread
+    self.order = 0 # Keeps writes with the same priority in the order they were asked for
+    self.orderLock = threading.Lock() # Protects order
+    self.reader = Thread(target=self.readLoop, daemon=True)
+    self.reader.start()
+    self.writer = Thread(target=self.writeLoop, daemon=True)
+    self.writer.start()
+    self.negotiate()
+
+  def readLoop(self): # Runs in its own thread for as long as the script runs
+    while True:
+      try:
+        line = self.ser.readline().decode('utf-8', 'replace').strip() # A whole line from Ard (ends in \r\n). Strip newline chars
+      except:
+        scriptLog.exception("[Serial Comms] [" + self.name + "] Problem reading from Arduino")
+        sleep(1)
+        continue
+      if line: self.lastHeard = monotonic()
+      if len(line) > 1 and line[0] == '{' and line[-1] == '}': # It's a frame
+        with self.cond:
+          self.frames.append((monotonic(), line[1:-1])) # Remove the curly braces (first and last char) from the string
+          self.cond.notify_all()
+        if line[1:-1] in ("open", "close") and self.onState: self.onState(line[1:-1])
+      elif len(line) > 1 and line[0] == '[' and line[-1] == ']': # It's a framed protocol answer
+        frame = parseFrame(line)
+        if frame == None:
+          scriptLog.warning("[Serial Comms] [" + self.name + "] Corrupt frame from Arduino: " + line)
+          continue # Whoever is waiting on it will send again
+        with self.cond:
+          self.replies[frame[0]] = frame[1]
+          self.cond.notify_all()
+        if frame[1] in ("open", "close") and self.onState: self.onState(frame[1])
+      elif line:
+        scriptLog.debug("[Serial Comms] [" + self.name + "] Arduino says: " + line)
+
+  def write(self, text, priority=CHATTER): # Queue text to send to the Arduino. Anything not inside { } or [ ] is ignored by it
+    data = bytes(text, 'UTF-8')
+    size = len(data)
+    if priority == self.CHATTER: size = self.chunk # Split up, so commands can go in between the pieces
+    with self.orderLock:
+      for start in range(0, len(data), size):
+        self.writes.put((priority, self.order, data[start:start + size]))
+        self.order = self.order + 1
+
+  def writeLoop(self): # Runs in its own thread for as long as the script runs. The only thing that writes to the port
+    while True:
+      priority, order, data = self.writes.get() # Blocks until there is something to send. Most urgent first
+      try:
+        self.ser.write(data)
+        self.ser.flush() # Wait until it has actually gone, so nothing else is sitting in the way of the next write
+      except:
+        scriptLog.exception("[Serial Comms] [" + self.name + "] Problem writing to Arduino")
+
+  def priority(self, action): # Which priority a command is sent with
+    if action in ("open", "close"): return self.ACTUATE
+    return self.QUERY
+
+  def waitFrame(self, wanted, since, timeout):
+    '''
+      Wait up to timeout seconds for a frame received after since (time.monotonic()) that wanted(frame) is
+      True for. It is taken so no one else gets it. Returns the frame, or None if it didn't arrive in time
+    '''
+    deadline = monotonic() + timeout
+    with self.cond:
+      while True:
+        for entry in self.frames:
+          if entry[0] >= since and wanted(entry[1]):
+            self.frames.remove(entry)
+            return entry[1]
+        left = deadline - monotonic()
+        if left <= 0:
+          return None
+        self.cond.wait(left)
+
+  def negotiate(self): # Find out if the Arduino understands the framed protocol. Older ones just ignore the question
+    reply = self.requestBraces("proto", timeout=3, resend=1)
+    if reply != None and reply[5:].isdigit():
+      self.protocol = int(reply[5:])
+    scriptLog.info("[Serial Comms] [" + self.name + "] Using " + \
+                   ("framed protocol version " + str(self.protocol) if self.protocol else "braces protocol"))
+
+  def request(self, action, timeout=180, resend=10):
+    '''
+      Send a command and wait for the Arduino to answer it. It answers open/close with the same command once it
+      is done (which takes a few seconds) and status with open or close. The command is sent again every resend
+      seconds in case it got lost, until timeout. Returns the answer, or None if nothing came back
+    '''
+    if self.protocol >= 1: reply = self.requestFramed(action, timeout, resend)
+    else: reply = self.requestBraces(action, timeout, resend)
+    self.unanswered = 0 if reply != None else self.unanswered + 1
+    return reply
+
+  def health(self): # How the link is doing, for /status. Doesn't touch the serial port
+    return {'protocol': self.protocol, 'unanswered': self.unanswered, 'queued': self.writes.qsize(),
+            'lastHeard': round(monotonic() - self.lastHeard, 1) if self.lastHeard != None else None}
+
+  def requestFramed(self, action, timeout, resend): # Same as request(), using the framed protocol
+    with self.cond:
+      self.seq = (self.seq + 1) % 256
+      seq = self.seq
+      self.replies.pop(seq, None) # Anything left over from the last time this ID was used
+    frame = makeFrame(seq, action)
+    deadline = monotonic() + timeout
+    while True:
+      self.write(frame, self.priority(action))
+      left = deadline - monotonic()
+      reply = self.waitReply(seq, min(resend, left))
+      if reply == "err" and left > 0: # Arduino got it corrupted. Send it again now
+        scriptLog.warning("[Serial Comms] [" + self.name + "] Arduino says request " + str(seq) + " was corrupt. Resending")
+        continue
+      if reply != None or left <= resend:
+        return reply
+
+  def waitReply(self, seq, timeout): # Wait up to timeout seconds for the framed answer to request ID seq
+    deadline = monotonic() + timeout
+    with self.cond:
+      while seq not in self.replies:
+        left = deadline - monotonic()
+        if left <= 0:
+          return None
+        self.cond.wait(left)
+      return self.replies.pop(seq)
+
+  def requestBraces(self, action, timeout, resend): # Same as request(), using braces
+    if action == "status": wanted = lambda frame: frame in ("open", "close")
+    elif action == "proto": wanted = lambda frame: frame.startswith("proto")
+    else: wanted = lambda frame: frame == action
+    since = monotonic()
+    deadline = since + timeout
+    while True:
+      self.write("{" + action + "}", self.priority(action)) # Send signal
+      left = deadline - monotonic()
+      reply = self.waitFrame(wanted, since, min(resend, left)) # Listen for acknowledgement
+      if reply != None or left <= resend:
+        return reply
+
 ######################################################################
 #################### END OF MAIN COOPENER PORTION ####################
 ############### BEGINNING OF FLASK WEB SERVER PORTION ################
 ######################################################################
 
 
-def doorWatch(door, url, port, myport):
+def doorWatch(door, url, port, myport, beatInterval=10):
   '''
-    This is a function run in a separate thread. Its purpose is to monitor a variable
-    for changes. The change can only be made by the Flask function which is accessed through
-    a HTTP GET. So a HTTP GET from the server can send us commands and this function will
-    monitor for those commands and execute them.
+    This is a function run in a separate thread. It keeps the connection to SmartHome up (handshake) and
+    sends a heartbeat every beatInterval seconds. Commands from SmartHome (sent to our /command, or in the
+    answer to a heartbeat) go on webCommands, and are carried out by commandWatch() as soon as they arrive.
   '''
+  Thread(target=commandWatch, args=(door,), daemon=True).start()
   sleep(5) # Wait 5 seconds for everything in main script to initialise, then try to connect
-  connected = False # This tracks the state of the HTTP connection to SmartHome
-  counter = 0 # Heartbeat timeout counter
-  delay = 0 # Introduce a delay between sending heartbeats
   myip = get_ip_address() # Get the WiFi IP of the RasPi
+  nextBeat = monotonic() + beatInterval
   while(True): # This thread keeps running
-    while(connected == False): # If connection is not made with SmartHome, then attempt to make it
-      try:
-        scriptLog.info("[HTTP Comms] >>> Attempting handshake with SmartHome. " + url + ":" + port)
-        result = urllib.request.urlopen(url + ":" + port + "/handshake?shake=1&ip=" + myip + "&port=" + myport).read()
-        # Attempt initial handshake with SmartHome. Returns a byte var
-        if result.decode("utf-8") == "OK(2)":
-          scriptLog.info("[HTTP Comms] <<< Recieved HTTP response. " + result.decode("utf-8"))
-          scriptLog.info("[HTTP Comms] >>> Sending HTTP data.")
-          result2 = urllib.request.urlopen(url + ":" + port + "/handshake?shake=3").read() # Complete handshake process
-          if result2.decode("utf-8") == "OK(4)":
-            scriptLog.info("[HTTP Comms] <<< Recieved HTTP response. " + result2.decode("utf-8"))
-            # Handshake complete. Set connection state as established.
-            scriptLog.info("[HTTP Comms] HTTP Connection established.")
-            connected = True
-            break # Exit the loop
-      except:
-        scriptLog.warning("[HTTP Comms] Exception. Problem connecting to SmartHome on " + url + ":" + port)
-      sleep(5) # Wait before trying again
-    delay = delay + 1
-    if (connected == True and delay % 10 == 0): # If connected then send a heartbeat signal
-      try:
-        result = urllib.request.urlopen(url + ":" + port + \
-                                        "/heartbeat?hbeat=0&otimeleft=" + str(door.getOpenTimeLeftInt()) + \
-                                        "&ctimeleft=" + str(door.getCloseTimeLeftInt()) + \
-                                        "&otime=" + door.getOpenTime().strftime("%H:%M") + \
-                                        "&ctime=" + door.getCloseTime().strftime("%H:%M") + \
-                                        "&state=" + door.getStatusNoArd()).read() # Send Coopener info to SmartHome
-        if result.decode("utf-8") == "OK(HB)":
-          counter = 0
-        else:
-          scriptLog.info("[HTTP Comms] Server says: " + result.decode("utf-8"))
-          scriptLog.info("[HTTP Comms] No response for heartbeat packet. (" + str(counter) + ")")
-          counter = counter + 1
-      except:
-        scriptLog.info("[HTTP Comms] Server says: " + result.decode("utf-8"))
-        scriptLog.info("[HTTP Comms] No response for heartbeat packet. (" + str(counter) + ")")
-        counter = counter + 1
-      if counter >= 3: # If too many heartbeat timeouts
-        counter = 0
-        connected = False # Reset connection
-
-# This code will execute actions given to it from SmartHome server
-    if (webData['flip']):
-      scriptLog.info("[HTTP Comms] Flipped door status to " + door.getStatusNoArd())
-      door.flipStatus()
-    if (webData['reconnect']):
-      scriptLog.info("[HTTP Comms] Received command to reconnect to SmartHome server")
-      connected = False
-    # Always setting back to False prevents commands from banking up/waiting while HTTP server disocnnected
-    threadLock.acquire() # Lock will prevent any other thread from modifying webData[] while we modify it
-    webData['flip'] = False # Set the variable used for HTTP comms back to False, waiting for next cmd
-    webData['reconnect'] = False
-    threadLock.release()
-    sleep(1)
+    while(door.getConnected() == False): # If connection is not made with SmartHome, then attempt to make it
+      if handshake(door, httpClient, url, port, myport, myip):
+        nextBeat = monotonic() + beatInterval
+        break # Exit the loop
+      watchWake.wait(5) # Wait before trying again
+      watchWake.clear()
+    if monotonic() >= nextBeat: # If connected then send a heartbeat signal
+      for cmd in heartbeat(door, httpClient, url, port): # SmartHome may answer with commands for us
+        webCommands.put((cmd, None))
+      nextBeat = monotonic() + beatInterval
+    watchWake.wait(max(0, nextBeat - monotonic())) # Until the next heartbeat, or a reconnect command
+    watchWake.clear()
+
+def commandWatch(door):
+  '''
+    Runs in its own thread. Carries out each command on webCommands as soon as it arrives, one at a time and in
+    the order they came in. Never waits on SmartHome, so a slow heartbeat can't hold up a command.
+    Each command comes with a queue to put the result on (see commandResult()), or None if nobody is waiting
+  '''
+  while True:
+    cmd, reply = webCommands.get() # Sleeps until there is one
+    try:
+      doCommand(door, cmd)
+    except:
+      scriptLog.exception("[HTTP Comms] Problem carrying out " + cmd)
+    if reply != None: reply.put(commandResult(door, cmd))
 
+def doorStatus(name=None):
+  '''
+    Every running door (or just door name) for /status. Each is the door's snapshot (see Door.publish()) with the
+    countdowns and link health worked out now. Never talks to the Arduino, so it is never held up by it.
+  '''
+  now = datetime.now().timestamp()
+  doors = []
+  for door in list(runningDoors.values()):
+    if name != None and door.name != name:
+      continue
+    entry = dict(door.snapshot)
+    for key in ("open", "close"):
+      at = entry.get(key + "Time")
+      entry[key + "TimeLeft"] = max(0, int(at - now)) if at != None else None
+    entry['serial'] = door.ser.health() if door.ser != None else None
+    entry['missedBeats'] = door.missedBeats
+    doors.append(entry)
+  return doors
+
+def commandResult(door, cmd):
+  '''
+    What happened when cmd was carried out on door. For /command?wait=
+  '''
+  if door == None:
+    return {'cmd': cmd, 'error': "door is not running"}
+  result = {'cmd': cmd, 'door': door.name, 'state': door.getStatusNoArd(), 'connected': door.getConnected()}
+  if cmd == "flip":
+    result['ack'] = door.ack # None if the Arduino never answered (or the door state wasn't known, so nothing was sent)
+    result['rtt'] = round(door.rtt, 3) if door.rtt != None else None
+  return result
+
+def doCommand(door, cmd):
+  '''
+    Carries out a command from SmartHome, whether it came with a heartbeat answer or to our /command
+  '''
+  if cmd == "flip":
+    scriptLog.info("[HTTP Comms] Flipped door status to " + door.getStatusNoArd())
+    door.flipStatus()
+  elif cmd == "reconnect":
+    scriptLog.info("[HTTP Comms] Received command to reconnect to SmartHome server")
+    door.setConnected(False)
+    watchWake.set() # So doorWatch() handshakes now, instead of at the next heartbeat
+
+def handshake(door, client, url, port, myport, myip):
+  '''
+    Handshake between Coopener and SmartHome srvr (see shake() in SmartHome's webtool.py). Tells SmartHome
+    our IP, the port we listen on for commands and which door this is. Returns True if the connection is made
+  '''
+  try:
+    scriptLog.info("[HTTP Comms] >>> Attempting handshake with SmartHome. " + url + ":" + port)
+    result = client.get(url + ":" + port + "/handshake?shake=1&ip=" + myip + "&port=" + myport + \
+                        "&id=" + urllib.parse.quote(door.name))
+    # Attempt initial handshake with SmartHome
+    if result == "OK(2)":
+      scriptLog.info("[HTTP Comms] <<< Recieved HTTP response. " + result)
+      scriptLog.info("[HTTP Comms] >>> Sending HTTP data.")
+      result2 = client.get(url + ":" + port + "/handshake?shake=3&id=" + urllib.parse.quote(door.name)) # Complete handshake process
+      if result2 == "OK(4)":
+        scriptLog.info("[HTTP Comms] <<< Recieved HTTP response. " + result2)
+        # Handshake complete. Set connection state as established.
+        scriptLog.info("[HTTP Comms] HTTP Connection established.")
+        door.missedBeats = 0
+        door.sent = None # SmartHome starts again from nothing, so the next heartbeat sends everything
+        door.setConnected(True)
+  except:
+    scriptLog.warning("[HTTP Comms] Exception. Problem connecting to SmartHome on " + url + ":" + port)
+  return door.getConnected()
+
+def heartbeat(door, client, url, port):
+  '''
+    Send the state of the door to SmartHome. To keep heartbeats small, only what has changed since the last
+    heartbeat SmartHome answered is sent, along with a sequence number (hbeat). If nothing has changed it is
+    just the sequence number. The first heartbeat after a handshake, or when SmartHome answers "resync",
+    sends everything and has full=1.
+    The countdowns (otimeleft/ctimeleft) are only sent with the open/close time, SmartHome counts them down itself.
+    If too many heartbeats in a row go unanswered the connection is reset, so the next thing done is a new handshake
+    SmartHome hands over commands waiting for us in its answer (eg. "OK(HB);cmd=flip,reconnect"). They are returned
+  '''
+  result = "" # What the server says back
+  state = None
+  try:
+    query, state = beatQuery(door)
+    result = client.get(url + ":" + port + "/heartbeat?" + query) # Send Coopener info to SmartHome
+  except:
+    pass
+  return beatAnswer(door, state, result)
+
+def beatQuery(door):
+  '''
+    The next heartbeat for door (see heartbeat()) as a query string, and the state it tells SmartHome about
+  '''
+  state = {'state': door.getStatusNoArd(), 'open': door.getOpenTime(), 'close': door.getCloseTime()}
+  sent = door.sent or {} # What SmartHome already has
+  door.beatSeq = door.beatSeq + 1
+  beat = "hbeat=" + str(door.beatSeq) + "&id=" + urllib.parse.quote(door.name)
+  if door.sent == None:
+    beat = beat + "&full=1"
+  if state['open'] != sent.get('open'):
+    beat = beat + "&otimeleft=" + str(door.getOpenTimeLeftInt()) + "&otime=" + state['open'].strftime("%H:%M")
+  if state['close'] != sent.get('close'):
+    beat = beat + "&ctimeleft=" + str(door.getCloseTimeLeftInt()) + "&ctime=" + state['close'].strftime("%H:%M")
+  if state['state'] != sent.get('state'):
+    beat = beat + "&state=" + state['state']
+  return beat, state
+
+def beatAnswer(door, state, result):
+  '''
+    Deals with what SmartHome said (result) to the heartbeat telling it about state. Returns any commands in it
+  '''
+  reply = result.split(";") # eg. "OK(HB)" or "OK(HB);resync" or "OK(HB);cmd=flip"
+  if reply[0] == "OK(HB)" and state != None:
+    door.missedBeats = 0
+    if "resync" in reply[1:]: door.sent = None # SmartHome has lost track. Send everything next time
+    else: door.sent = state
+    commands = []
+    for token in reply[1:]:
+      if token.startswith("cmd="): commands = commands + [cmd for cmd in token[4:].split(",") if cmd]
+    return commands
+  scriptLog.info("[HTTP Comms] Server says: " + result)
+  scriptLog.info("[HTTP Comms] No response for heartbeat packet. (" + str(door.missedBeats) + ")")
+  door.missedBeats = door.missedBeats + 1
+  if door.missedBeats >= 3: # If too many heartbeat timeouts
+    door.missedBeats = 0
+    door.setConnected(False) # Reset connection
+  return []
 
 def flask():
   '''
     This is a web service function which listens for HTTP commands sent from SmartHome server (which is also running
     python/flask).
     The only commands we expect are to reconnect or flip the status of the door.
-    When received, they are stored in a variable (webData). The other function doorWatch() is executed in another thread
-    which then sees any changes on the variable and acts on them. It might be a good idea to combine both these functions
-    in to one and run them under one thread. Maybe later...
+    When received, they are put on a queue (webCommands). commandWatch() runs in another thread, it wakes up as soon
+    as a command is put on the queue and carries it out. Commands are never merged or dropped.
+    The answers come from statusReply() and commandReply(), so this and httpListener() behave the same.
   '''
-  from flask import Flask
-  import os
-  import requests
-  from flask import Flask, render_template, request
-  import urllib.request
-  import socket
+  from flask import Flask, request
 
   app = Flask(__name__)
 
-  connstate = 0
-
   @app.route("/")
   def hello():
     return "Hello World! - Love from Coopener"
 
+  @app.route("/status")
+  def status():
+    return statusReply(request.args)
+
   @app.route("/command")
   def cmd():
-    if request.args.get('cmd'):
-      scriptLog.info("[HTTP Comms] Received command \'" + request.args.get('cmd') + "\'")
-      cmd = request.args.get('cmd')
-      threadLock.acquire() # Enable lock to avoid Coopener main script from messing with the contents
-      if (cmd == "flip"):
-        webData['flip'] = True
-      elif (cmd == "reconnect"):
-        webData['reconnect'] = True
-      else:
-        threadLock.release()
-        return ("Invalid command "+ str(webData))
-      threadLock.release()
-      return returnText(webData)
+    return commandReply(request.args)
+
+  app.run(debug=True, use_reloader=False, host="0.0.0.0")
+
+def httpListener(port=5000):
+  '''
+    The same as flask(), but built on Python's own threaded HTTP server. Every request gets its own thread, so a
+    /command?wait=N doesn't hold up anyone else, and Flask (and everything it imports) is never loaded.
+    Pick it, or flask(), with listener at the bottom of the script.
+  '''
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from socketserver import ThreadingMixIn
+
+  class Server(ThreadingMixIn, HTTPServer): # http.server.ThreadingHTTPServer, which Python 3.4 doesn't have
+    daemon_threads = True # Don't wait for requests still going (eg. a long wait=N) when the script stops
 
+  class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+      path, _, query = self.path.partition("?")
+      args = {name: values[0] for name, values in urllib.parse.parse_qs(query).items()} # First value, like Flask
+      try:
+        if path == "/":
+          answer = "Hello World! - Love from Coopener"
+        elif path == "/status":
+          answer = statusReply(args)
+        elif path == "/command":
+          answer = commandReply(args)
+        else:
+          answer = ("Not found", 404)
+      except:
+        scriptLog.exception("[HTTP Comms] Problem answering " + self.path)
+        answer = ("Internal server error", 500) # Like Flask, rather than hanging up on them
+      if not isinstance(answer, tuple):
+        answer = (answer,)
+      body = answer[0].encode()
+      self.send_response(answer[1] if len(answer) > 1 else 200)
+      headers = {'Content-Type': "text/html; charset=utf-8"}
+      headers.update(answer[2] if len(answer) > 2 else {})
+      for name, value in headers.items():
+        self.send_header(name, value)
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      scriptLog.debug("[HTTP Comms] " + self.address_string() + " " + (format % args))
+
+  server = Server(("0.0.0.0", int(port)), Handler)
+  server.serve_forever()
+
+def statusReply(args):
+  '''
+    /status: The state, open/close times, countdowns and serial and SmartHome link health of the door(s) as JSON.
+    ?door= for just one door. Made from what we already know, it never waits for the Arduino.
+    args is the query string as a dict. Returns what a Flask view would (body, or (body, status, headers))
+  '''
+  doors = doorStatus(args.get('door'))
+  if args.get('door') != None:
+    if not doors:
+      return ("No door " + str({'door': args.get('door')})), 404
+    doors = doors[0]
+  return json.dumps(doors), 200, {'Content-Type': "application/json"}
+
+def commandReply(args):
+  '''
+    /command: ?cmd=flip or reconnect (and &door= if running more than one door). Answers straight away, unless
+    &wait=N is given. Then it waits up to N seconds for the command to be done and answers with the result as
+    JSON: the door state, the Arduino's ACK and the serial round trip time (rtt) in seconds
+  '''
+  if args.get('cmd'):
+    scriptLog.info("[HTTP Comms] Received command \'" + args.get('cmd') + "\'")
+    cmd = args.get('cmd')
+    reply = None
+    if args.get('wait'):
+      try:
+        wait = float(args.get('wait'))
+        if not math.isfinite(wait): raise ValueError # nan gets past min()/max() and would wait forever
+        wait = min(max(wait, 0), 180) # Never longer than the serial timeout
+      except ValueError:
+        return ("Invalid wait " + str({'wait': args.get('wait')})), 400
+      reply = queue.Queue(1)
+    if doorRuntime != None: # Running more than one door. The command goes straight to the door it is for
+      if not doorRuntime.command(args.get('door'), cmd, reply):
+        return ("Invalid command or door " + str({'door': args.get('door'), 'cmd': cmd}))
+    elif cmd in ("flip", "reconnect"):
+      webCommands.put((cmd, reply)) # Wakes commandWatch() straight away
     else:
-      scriptLog.info("[HTTP Comms] Received invalid command")
-      return ("Invalid HTTP syntax "+ str(webData))
+      return ("Invalid command " + str({'cmd': cmd}))
+    if reply == None:
+      return returnText({'door': args.get('door'), 'cmd': cmd})
+    started = monotonic()
+    try:
+      result = reply.get(timeout=wait)
+      code = 200
+    except queue.Empty: # Still going (or stuck behind something else). It will still be done
+      result = {'cmd': cmd, 'error': "timed out"}
+      code = 504
+    result['elapsed'] = round(monotonic() - started, 3)
+    return json.dumps(result), code, {'Content-Type': "application/json"}
 
-  app.run(debug=True, use_reloader=False, host="0.0.0.0")
+  else:
+    scriptLog.info("[HTTP Comms] Received invalid command")
+    return ("Invalid HTTP syntax " + str(dict(args)))
 
-webData = {
-  'flip' : False,
-  'reconnect' : False,
-}
+interrupts = ("shutdown", "reload", "refresh") # Scheduler actions which stop main() waiting for the day's door actions
+schedulers = [] # Scheduler of every Coopener instance running, so signal handlers can wake them
+unclaimed = [] # Interrupts received before any scheduler was there to take them. See addScheduler()
+schedulersLock = threading.Lock() # Protects schedulers and unclaimed
 
-def returnText(webData):
+def addScheduler(scheduler):
+  '''
+    Lets the signal handlers wake scheduler up for a shutdown, reload or refresh. Anything asked for before
+    there was a scheduler is handed to it now, so a kill -TERM during startup isn't lost
+  '''
+  with schedulersLock:
+    schedulers.append(scheduler)
+    for reason in unclaimed:
+      scheduler.addIn(0, reason)
+    del unclaimed[:]
+
+def interruptSchedulers(signum, frame):
+  '''
+    Signal handler. SIGTERM/SIGINT asks every Coopener instance to shut down, SIGHUP to reload and
+    SIGUSR1 to refresh today's open/close times. Each scheduler wakes up at once, so there is no lag.
+  '''
+  reason = {signal.SIGTERM: "shutdown", signal.SIGINT: "shutdown",
+            signal.SIGHUP: "reload", signal.SIGUSR1: "refresh"}[signum]
+  scriptLog.info("Received signal " + str(signum) + ". Asking Coopener to " + reason)
+  with schedulersLock:
+    if not schedulers:
+      unclaimed.append(reason) # Nothing has started yet. The first scheduler gets it
+    for scheduler in schedulers:
+      scheduler.addIn(0, reason)
+
+webCommands = queue.Queue() # Commands from SmartHome waiting for commandWatch() to carry them out, in order
+watchWake = threading.Event() # Set to stop doorWatch() waiting, eg. to handshake again straight away
+
+def returnText(result):
   return "<!DOCTYPE html> \
           <html><head><style type=\"text/css\"> \
             .back { \
@@ -801,36 +1873,57 @@ def returnText(webData):
               -o-transition: background-color 0.3s cubic-bezier(0, 0, 0, 0), color 0.3s cubic-bezier(0, 0, 0, 0), width 0.3s cubic-bezier(0, 0, 0, 0), border-width 0.3s cubic-bezier(0, 0, 0, 0), border-color 0.3s cubic-bezier(0, 0, 0, 0); \
               transition: background-color 0.3s cubic-bezier(0, 0, 0, 0), color 0.3s cubic-bezier(0, 0, 0, 0), width 0.3s cubic-bezier(0, 0, 0, 0), border-width 0.3s cubic-bezier(0, 0, 0, 0), border-color 0.3s cubic-bezier(0, 0, 0, 0); \
             } \
-            </style></head><body>" + str(webData) + "<br><FORM> \
+            </style></head><body>" + str(result) + "<br><FORM> \
             <INPUT class=\"back\" TYPE=\"button\" onClick=\"history.go(-1);return true;\" VALUE=\"Back\"></FORM></body></html>"
 
 doorFlip = False
+doorRuntime = None # The DoorRuntime, if runDoors() is running more than one door
+runningDoors = {} # Name -> Door, for every door started. See /status
+httpClient = HttpClient() # Used for everything sent over HTTP (SmartHome and the twilight website)
 
 if __name__ == "__main__":
   ### Configuration ###
-  # It is possible to control more than one door by running a separate thread for each door.
+  # It is possible to control more than one door, by adding the other doors to moreDoors below.
   # This would allow you to have a different door at a different geographical location,
   # and save open/close times to a different file. Everything is logged to same file.
   # I can't think of a use case for this, but the point here is to flesh this code out so we
   # can use it for other SmartHome applications.
-  # Below configuration is for just one Coopener thread. You could create multiple if you chose to.
+  # Below configuration is for the first (or only) door.
   name = "Coopener1" # Name of the coopener instance
   latitude = "-33.81528" # Your location latitude
   longitude = "151.10111" # Your location longitude
   filename = "/home/pi/bin/twilight.txt" # Filename to store door open and close times in
+  twilightSource = "offline" # "offline" works the twilight times out on the Pi. "api" gets them from api.sunrise-sunset.org
+                             # and only works them out if the website can't be reached
+  tablefile = "/home/pi/bin/twilight.tbl" # Precomputed twilight times, see --build_table. Used first if it exists
   serialName = "/dev/ttyAMA0" # Name of serial interface used to talk to Arduino
   url = "http://coopener.smarthome.vorignet.com" # SmartHome Server URL
   port = "80" # This is the port SmartHome server is listening on
   myport = "5000" # This is the port that Coopener is listening on for return comms
+  moreDoors = [] # Any other doors to run, all from one thread. Each door needs its own name, location, serial and files
+  #moreDoors = [{'name': "Coopener2", 'latitude': "-33.81528", 'longitude': "151.10111", 'serialName': "/dev/ttyUSB0",
+  #              'filename': "/home/pi/bin/twilight2.txt", 'tablefile': "/home/pi/bin/twilight2.tbl"}]
+  bulkBeats = False # With moreDoors, send all the doors' heartbeats in one request (SmartHome needs /heartbeats)
+  listener = "stdlib" # What listens on myport for SmartHome. "stdlib" is Python's own threaded HTTP server,
+                      # "flask" is the Flask development server (needs Flask installed)
 
   #####################
   script = __file__ # Get the name of this file
 
-  threadLock = threading.Lock() # When this lock is active in one thread the other thread that tries
-  # to activate it will need to wait until the lock has been released.
-  t1 = Thread(target=main, args=(latitude, longitude, script, url, port, myport, serialName, name, filename))
-  t2 = Thread(target=flask)
+  if moreDoors: # Run this door and the others from a single DoorRuntime
+    doors = [{'name': name, 'latitude': latitude, 'longitude': longitude, 'serialName': serialName,
+              'filename': filename, 'tablefile': tablefile}] + moreDoors
+    t1 = Thread(target=runDoors, args=(doors, script, url, port, myport, twilightSource, bulkBeats))
+  else:
+    t1 = Thread(target=main, args=(latitude, longitude, script, url, port, myport, serialName, name, filename, twilightSource, tablefile))
+  if listener == "flask":
+    t2 = Thread(target=flask, daemon=True) # Daemon threads don't keep the script alive once main() has stopped
+  else:
+    t2 = Thread(target=httpListener, args=(myport,), daemon=True)
   #t2 = Thread(target=main, args=(latitude, longitude, script, serialName, name, filename))
+  for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1):
+    signal.signal(signum, interruptSchedulers) # kill -TERM to stop, -HUP to reload, -USR1 to refresh times
   t1.start()
   t2.start()
   print ("Started thread: " + name)
+  t1.join() # Only the main thread gets signals, so it waits here until main() has shut down
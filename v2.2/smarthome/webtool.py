@@ -3,76 +3,740 @@
 from flask import Flask
 import os
 import requests
-from flask import Flask, render_template, request
+from flask import Flask, render_template, request, Response
 import urllib.request
+import urllib.parse
 import time
+import threading
+import sqlite3
+import json
+import math
+import hashlib
+import queue
+import fcntl
+from threading import Thread
 from time import sleep
 
 app = Flask(__name__)
 
-# Initialising variables to be used globally... yes, I know. Global vars are ugly... fml. Ill fix next time.
-d = {'otimeleft': 0, # Number of second left until this action is taken
-    'ctimeleft': 0,
-    'otime': "", # Actual open time HH:MM
-    'ctime': "",
-    'state': "", # State of the door (open/close)
-    'ip': "", # Coopener should tell us what its IP is
-    'port': "", # Coopener should tell us what port its listening on
-    'connstate': False, # Used to track connection status of Coopener to SmartHome
-    'lastSeen': int(time.time()), # Number of seconds since epoch. Used to track heartbeats for connection
-    'timeout': 30} # Number of seconds to wait for heartbeat before dropping connection
+class Devices:
+  '''
+    Every Coopener we know about, keyed by the id it sends us (older Coopeners don't send one, they get defaultId).
+    Each device has its own lock so heartbeats from different Coopeners never wait on each other.
+    The state of a device is never changed in place, a changed copy replaces it. Anything only reading
+    (like index()) gets a consistent snapshot without taking any lock.
+  '''
+  def __init__(self, timeout=30):
+    self.timeout = timeout # Number of seconds to wait for heartbeat before dropping connection
+    self.devices = {} # id: state of the device. See new()
+    self.locks = {} # id: lock used while changing the state of the device
+    self.lock = threading.Lock() # Only used when a device is added
+    self.onChange = None # Called with the new state whenever a device changes (its version goes up)
+    self.epoch = newEpoch() # Versions start again from 0 when we restart, so ETags include this. See statusOf()
+
+  def new(self, id):
+    return {'id': id,
+            'odeadline': 0, # Number of seconds since epoch when the door opens. otimeleft is worked out from this
+            'cdeadline': 0,
+            'otime': "", # Actual open time HH:MM
+            'ctime': "",
+            'state': "", # State of the door (open/close)
+            'ip': "", # Coopener should tell us what its IP is
+            'port': "", # Coopener should tell us what port its listening on
+            'connstate': False, # Used to track connection status of Coopener to SmartHome
+            'lastSeen': int(time.time()), # Number of seconds since epoch. Used to track heartbeats for connection
+            'seq': None, # Sequence number of the last heartbeat used. None until Coopener has sent us everything
+            'version': 0, # Counts changes to this device. See changed()
+            'commands': []} # [command, when it was queued] waiting to go to Coopener with its next heartbeat.
+                            # See queueCommand()
+
+  def get(self, id):
+    '''
+      Snapshot of the state of device id, None if we have never heard of it
+    '''
+    return self.devices.get(id)
+
+  def all(self):
+    '''
+      Snapshots of every device, in the order we first heard from them
+    '''
+    return list(self.devices.values())
+
+  def update(self, id, change, create=True):
+    '''
+      Runs change(state) on a copy of the state of device id (adding the device if it is new) and then
+      replaces the state with that copy. Returns whatever change() returns.
+      If create is False and we have never heard of id, nothing is done and None is returned.
+    '''
+    if not create and id not in self.devices:
+      return None
+    lock = self.locks.get(id)
+    if lock == None:
+      with self.lock:
+        lock = self.locks.setdefault(id, threading.Lock())
+    with lock:
+      old = self.devices.get(id)
+      state = dict(old or self.new(id))
+      result = change(state)
+      self.devices[id] = state
+      if self.changed(old, state) and self.onChange: self.onChange(state)
+      return result
+
+  def updateMany(self, changes, create=True):
+    '''
+      update() for each (id, change) in changes, in order. Returns a list of what each change() returned
+    '''
+    return [self.update(id, change, create) for id, change in changes]
+
+  def changed(self, old, state):
+    '''
+      Bumps the version of state if anything anyone looking at it cares about has changed.
+      lastSeen and seq change with every heartbeat so they don't count, and nobody sees commands.
+    '''
+    ignore = ('lastSeen', 'seq', 'version', 'commands')
+    if old == None or any(state[key] != old.get(key) for key in state if key not in ignore):
+      state['version'] = state['version'] + 1
+      return True
+    return False
+
+  def alive(self, state):
+    return state['connstate'] and (int(time.time()) - state['lastSeen']) < self.timeout
+
+def newEpoch():
+  return hashlib.sha1(os.urandom(16)).hexdigest()[:8]
+
+class SqliteDevices(Devices):
+  '''
+    Same as Devices but the state is kept in an SQLite database (in WAL mode), so every process using the same
+    file sees the same devices. Needed when mod_wsgi runs more than one process. Each thread in each process
+    has its own connection. Changes are done in a write transaction so two processes can't both change a device.
+  '''
+  def __init__(self, filename, timeout=30):
+    Devices.__init__(self, timeout)
+    self.filename = filename
+    self.local = threading.local()
+    db = self.connect()
+    db.execute("CREATE TABLE IF NOT EXISTS devices (id TEXT PRIMARY KEY, state TEXT NOT NULL)")
+    db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    # The versions live as long as the file does, so does the epoch. Every process gets the same one
+    db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('epoch', ?)", (self.epoch,))
+    self.epoch = db.execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()[0]
+    db.close()
+    self.local.db = None # Don't share this connection with a process we might be forked in to
+
+  def connect(self):
+    db = sqlite3.connect(self.filename, timeout=10, isolation_level=None) # We do our own transactions
+    db.execute("PRAGMA journal_mode=WAL") # Readers don't wait for writers, and writers don't wait for readers
+    db.execute("PRAGMA synchronous=NORMAL") # Losing the last heartbeat in a power cut is ok
+    return db
+
+  def db(self):
+    if getattr(self.local, 'db', None) == None or self.local.pid != os.getpid():
+      self.local.db = self.connect()
+      self.local.pid = os.getpid()
+    return self.local.db
+
+  def get(self, id):
+    row = self.db().execute("SELECT state FROM devices WHERE id = ?", (id,)).fetchone()
+    return self.load(row[0]) if row else None
+
+  def all(self):
+    return [self.load(row[0]) for row in self.db().execute("SELECT state FROM devices ORDER BY rowid")]
+
+  def load(self, text):
+    state = json.loads(text)
+    return dict(self.new(state['id']), **state) # Anything added to new() since this was saved gets its default
+
+  def update(self, id, change, create=True):
+    return self.updateMany([(id, change)], create)[0]
+
+  def updateMany(self, changes, create=True):
+    '''
+      All of changes are done in one transaction, so a batch only takes the write lock (and syncs) once
+    '''
+    db = self.db()
+    results = []
+    changed = [] # States that went up a version
+    db.execute("BEGIN IMMEDIATE") # Take the write lock now, before reading what we are going to change
+    try:
+      for id, change in changes:
+        row = db.execute("SELECT state FROM devices WHERE id = ?", (id,)).fetchone()
+        if not row and not create:
+          results.append(None)
+          continue
+        old = self.load(row[0]) if row else None
+        state = dict(old or self.new(id))
+        results.append(change(state))
+        if self.changed(old, state): changed.append(state)
+        if row: db.execute("UPDATE devices SET state = ? WHERE id = ?", (json.dumps(state), id))
+        else: db.execute("INSERT INTO devices (id, state) VALUES (?, ?)", (id, json.dumps(state)))
+      db.execute("COMMIT")
+    except:
+      db.execute("ROLLBACK")
+      raise
+    for state in changed:
+      if self.onChange: self.onChange(state) # Only tells viewers connected to this process
+    return results
+
+class History:
+  '''
+    Appends every heartbeat and door state change to filename, one JSON object per line.
+    record() only puts the entry on a queue. A background thread writes them out in batches, once it has
+    batch entries or the oldest one has waited delay seconds, and fsyncs once per batch. So a heartbeat
+    never waits for the disk.
+    Once the file would go over maxBytes it is renamed to filename.1 (.1 to .2 and so on, only backups of them
+    are kept), like the Coopener's log. Every process writes to the same file, so it is locked while written to.
+    An empty filename turns history off.
+  '''
+  def __init__(self, filename, batch=200, delay=0.5, size=10000, maxBytes=100*1024*1024, backups=5):
+    self.filename = filename
+    self.batch = batch
+    self.delay = delay
+    self.maxBytes = maxBytes # 0 never rotates
+    self.backups = backups
+    self.queue = queue.Queue(size)
+    self.dropped = 0 # Entries thrown away because the queue was full
+    self.reported = 0 # What dropped was when it was last logged
+    self.lock = threading.Lock()
+    self.pid = None
+
+  def record(self, id, event, **fields):
+    if not self.filename:
+      return
+    if self.pid != os.getpid(): # Not started yet in this process (mod_wsgi may fork after importing us)
+      with self.lock: # Two requests at once mustn't both start a writer, their batches could go out of order
+        if self.pid != os.getpid():
+          self.pid = os.getpid()
+          Thread(target=self.writeLoop, daemon=True).start()
+    fields.update(t=round(time.time(), 3), id=id, event=event)
+    try:
+      self.queue.put_nowait(fields)
+    except queue.Full: # Disk can't keep up. Better to lose history than to hold up the heartbeat
+      self.dropped += 1
+
+  def recordAll(self, entries):
+    '''
+      record() each (id, event, fields) in entries. Changes to a device collect their entries and hand them
+      over here once the change is stored, so nothing is recorded for a change that was rolled back
+    '''
+    for id, event, fields in entries:
+      self.record(id, event, **fields)
+
+  def writeLoop(self):
+    while True:
+      entries = [self.queue.get()]
+      deadline = time.monotonic() + self.delay
+      while len(entries) < self.batch:
+        try:
+          entries.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+        except queue.Empty:
+          break
+      data = "".join(json.dumps(entry) + "\n" for entry in entries).encode()
+      try:
+        fd = self.open()
+        try:
+          size = os.fstat(fd).st_size
+          if self.maxBytes and size > 0 and size + len(data) > self.maxBytes: # A batch bigger than that still goes in
+            self.rotate()
+            os.close(fd)
+            fd = None
+            fd = self.open()
+          os.write(fd, data) # One write per batch, so lines from other processes don't get mixed in to ours
+          os.fsync(fd)
+        finally:
+          if fd != None: os.close(fd) # Also unlocks it
+      except OSError as e:
+        app.logger.error("Could not write %d history entries to %s: %s", len(entries), self.filename, e)
+      if self.dropped != self.reported:
+        app.logger.warning("History can't keep up, %d entries dropped (%d since starting)",
+                           self.dropped - self.reported, self.dropped)
+        self.reported = self.dropped
+
+  def open(self):
+    '''
+      The history file, open for appending and locked. If another process rotated it while we were waiting
+      for the lock, the new file is opened instead
+    '''
+    while True:
+      fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        if os.stat(self.filename).st_ino == os.fstat(fd).st_ino:
+          return fd
+      except FileNotFoundError: # Renamed, and the new one not made yet
+        pass
+      except:
+        os.close(fd)
+        raise
+      os.close(fd)
+
+  def rotate(self): # Only with the file locked (see open())
+    if self.backups < 1:
+      os.remove(self.filename)
+      return
+    for n in range(self.backups - 1, 0, -1):
+      if os.path.exists("%s.%d" % (self.filename, n)):
+        os.replace("%s.%d" % (self.filename, n), "%s.%d" % (self.filename, n + 1))
+    os.replace(self.filename, self.filename + ".1")
+
+  def health(self): # For /api/health. Only this process's queue
+    return {'enabled': bool(self.filename), 'queued': self.queue.qsize(), 'dropped': self.dropped}
+
+class Broadcaster:
+  '''
+    Hands every message published to each subscriber's queue. A subscriber that doesn't keep up
+    misses messages rather than holding up whoever is publishing.
+  '''
+  def __init__(self, size=100):
+    self.size = size
+    self.subscribers = set()
+    self.lock = threading.Lock()
+
+  def subscribe(self, subscriber=None):
+    '''
+      Returns a new subscriber, a queue messages are put on. subscriber can be anything with a put_nowait()
+      that raises queue.Full when it has had enough (see webtool_async.py)
+    '''
+    if subscriber == None: subscriber = queue.Queue(self.size)
+    with self.lock:
+      self.subscribers.add(subscriber)
+    return subscriber
+
+  def unsubscribe(self, subscriber):
+    with self.lock:
+      self.subscribers.discard(subscriber)
+
+  def publish(self, message):
+    with self.lock:
+      subscribers = list(self.subscribers)
+    for subscriber in subscribers:
+      try:
+        subscriber.put_nowait(message)
+      except queue.Full:
+        pass
+
+class Liveness:
+  '''
+    Notices devices that have stopped sending heartbeats, whether or not anyone is looking at the page.
+    It is a hashed timer wheel: a tick is tick seconds long and slots[n % size] holds the devices that are due
+    on tick n (or on tick n plus some multiple of size). Moving a device to a new deadline is O(1) and each tick
+    only looks at one slot, so thousands of devices cost next to nothing. expired(id) is called from the wheel's
+    thread at most a tick after the deadline of id has passed.
+  '''
+  def __init__(self, expired, existing, tick=1, size=512):
+    self.expired = expired
+    self.existing = existing # Returns (id, deadline) of devices to watch when we start. See start()
+    self.tick = tick
+    self.size = size
+    self.lock = threading.Lock()
+    self.pid = None
+
+  def start(self):
+    '''
+      Starts the wheel turning in this process, if it isn't already. mod_wsgi may fork after importing us,
+      or restart a process, so we also start watching every device that was connected before.
+    '''
+    if self.pid == os.getpid(): return
+    with self.lock:
+      if self.pid == os.getpid(): return
+      self.pid = os.getpid()
+      self.slots = [set() for i in range(self.size)]
+      self.deadlines = {} # id: tick it is due on
+      self.now = int(time.time() / self.tick) # Last tick done
+    for id, deadline in self.existing():
+      self.touch(id, deadline)
+    Thread(target=self.run, daemon=True).start()
+
+  def touch(self, id, deadline):
+    '''
+      (Re)arms id to expire at deadline (seconds since epoch)
+    '''
+    with self.lock:
+      due = max(int(math.ceil(deadline / self.tick)), self.now + 1)
+      old = self.deadlines.get(id)
+      if old != None: self.slots[old % self.size].discard(id)
+      self.deadlines[id] = due
+      self.slots[due % self.size].add(id)
+
+  def run(self):
+    while True:
+      sleep(self.tick - time.time() % self.tick) # Wait for the start of the next tick
+      now = int(time.time() / self.tick)
+      while self.now < now: # Normally once, more if we have fallen behind
+        with self.lock:
+          self.now = max(self.now + 1, now - self.size) # After a full turn every slot has been looked at
+          slot = self.slots[self.now % self.size]
+          due = [id for id in slot if self.deadlines[id] <= self.now]
+          for id in due:
+            slot.discard(id)
+            del self.deadlines[id]
+        for id in due:
+          try:
+            self.expired(id)
+          except Exception:
+            app.logger.exception("Could not expire %s", id)
+
+# Where device state is kept. "memory" is fastest, but is only seen by one process. If mod_wsgi runs more than
+# one process use "sqlite", every process then uses the same database file. See webtool.wsgi
+stateStore = os.environ.get('SMARTHOME_STORE', "memory")
+stateFile = os.environ.get('SMARTHOME_DB', "/var/www/flask-prod/smarthome.db")
+historyFile = os.environ.get('SMARTHOME_HISTORY', "/var/www/flask-prod/history.jsonl") # "" for no history
+historyMegabytes = int(os.environ.get('SMARTHOME_HISTORY_MB', 100)) # Size the history file is rotated at
+historyBackups = int(os.environ.get('SMARTHOME_HISTORY_KEEP', 5)) # Rotated history files kept
+
+defaultId = "Coopener" # id of Coopeners too old to send one
+maxCommands = 10 # Most commands that can be waiting for a Coopener
+commandTtl = 30 # Seconds a queued command waits for a heartbeat to go out with (a few of Coopener's heartbeats)
+maxBatch = 1000 # Most heartbeats in one POST to /heartbeats
+devices = SqliteDevices(stateFile) if stateStore == "sqlite" else Devices()
+history = History(historyFile, maxBytes=historyMegabytes*1024*1024, backups=historyBackups)
+broadcaster = Broadcaster()
+devices.onChange = broadcaster.publish
+keepalive = 15 # Seconds between checks for changes we weren't told about (made by other processes)
+maxStreams = 4 # Most /events streams open at once in this process. Each one holds a worker thread (Flask's, or
+               # mod_wsgi's) for as long as the page is open, so this many viewers take this many threads away
+               # from heartbeats. Keep it well under the threads mod_wsgi has. webtool_async.py has no such limit,
+               # its streams don't use a thread each
+streams = threading.BoundedSemaphore(maxStreams)
+
+def expireDevice(id):
+  '''
+    Called by liveness once id should have sent another heartbeat. Drops its connection, unless another
+    process has heard from it since, then we keep watching it instead.
+  '''
+  entries = [] # History, recorded once the change is stored
+  state = devices.update(id, lambda state: expire(state, entries))
+  history.recordAll(entries)
+  if state['connstate']: liveness.touch(id, state['lastSeen'] + devices.timeout)
+
+liveness = Liveness(expireDevice, lambda: [(state['id'], state['lastSeen'] + devices.timeout) \
+                                          for state in devices.all() if state['connstate']])
+
+@app.before_request
+def startLiveness():
+  liveness.start()
+
+renderEvery = 5 # Seconds a rendered index page is reused for if no device has changed. The countdowns on it are
+                # up to this much out of date, until the page starts counting down itself. 0 renders every time
+lastRender = (None, None) # (key, page) of the last index page rendered
+
+# The routes are thin, the work is done by the functions they call (indexPage(), statusOf(), handshakeReply(),
+# heartbeatReply(), heartbeatsReply(), queueCommand() and healthReply()). webtool_async.py serves the same things by calling them too.
 
 @app.route("/")
 def index():
-  global d
-  if (int(time.time()) - d['lastSeen']) >= d['timeout']:
-    d['connstate'] = False
-    return render_template('index.html', connstate=d['connstate'])
-  return render_template('index.html', connstate=d['connstate'], \
-                        otimeleft=d['otimeleft'], ctimeleft=d['ctimeleft'], \
-                        otime=d['otime'], ctime=d['ctime'], state=d['state'], \
-                        ip=d['ip'], port=d['port'])
+  return indexPage(lambda views: render_template('index.html', devices=views))
+
+def indexPage(render):
+  '''
+    The page is only rendered again (by render(views)) once a device has changed (its version)
+    or renderEvery seconds have passed
+  '''
+  global lastRender
+  states = devices.all()
+  key = (tuple((state['id'], state['version']) for state in states), \
+         int(time.time() / renderEvery) if renderEvery > 0 else time.time())
+  if lastRender[0] == key:
+    return lastRender[1]
+  views = []
+  for state in states:
+    view = dict(state, otimeleft=timeLeft(state['odeadline']), ctimeleft=timeLeft(state['cdeadline']))
+    views.append(view)
+  page = render(views)
+  lastRender = (key, page)
+  return page
+
+@app.route("/api/status")
+def status():
+  '''
+    State of one device (?id=) or all of them as JSON. Countdowns are sent as deadlines (seconds since epoch)
+    so the answer only changes when a device does. The ETag is made from the device versions (and the epoch of
+    the store, so a restart that starts them again from 0 doesn't match an old ETag), a client
+    sending it back in If-None-Match gets an empty 304 until something changes.
+  '''
+  id = request.args.get('id')
+  found = statusOf(id)
+  if found == None:
+    return "No device found", 404
+  etag, body = found
+  if etag in request.if_none_match:
+    response = Response(status=304)
+  else:
+    response = Response(body(), mimetype='application/json')
+  response.set_etag(etag)
+  response.headers['Cache-Control'] = "no-cache" # Always check with us, but the 304 is cheap
+  return response
+
+def statusOf(id=None):
+  '''
+    (etag, body) for device id, or every device if id is None. body() makes the JSON, so it needn't be made
+    when the client already has it. None if there is no such device
+  '''
+  if id != None:
+    state = devices.get(id)
+    if state == None:
+      return None
+    etag = "%s-%s-%d" % (devices.epoch, hashlib.sha1(id.encode()).hexdigest()[:8], state['version'])
+    return etag, lambda: json.dumps(public(state), separators=(',', ':'))
+  states = devices.all()
+  versions = " ".join("%s %d" % (state['id'], state['version']) for state in states)
+  etag = "%s-%s" % (devices.epoch, hashlib.sha1(versions.encode()).hexdigest()[:16])
+  return etag, lambda: json.dumps([public(state) for state in states], separators=(',', ':'))
+
+@app.route("/api/health")
+def health():
+  return Response(healthReply(), mimetype='application/json')
+
+def healthReply():
+  '''
+    How this process is doing, as JSON. For now just the history writer: entries waiting to be written and
+    entries dropped because the disk couldn't keep up
+  '''
+  return json.dumps({'history': history.health()})
+
+@app.route("/events")
+def stream():
+  '''
+    Server-Sent Events stream of device changes, for one device (?id=) or all of them. Every device is sent
+    once to start with, then again each time it changes. Each message is the device as /api/status has it,
+    plus now (seconds since epoch) so the page can count down without asking again.
+    Only maxStreams at a time, after that viewers get a 503 and the page just isn't updated live.
+  '''
+  id = request.args.get('id')
+  if not streams.acquire(blocking=False):
+    return "Too many live viewers", 503
+  def events():
+    subscriber = broadcaster.subscribe()
+    try:
+      versions = {} # id: version last sent
+      states = streamStates(id)
+      while True:
+        for state in states:
+          event = streamEvent(state, id, versions)
+          if event: yield event
+        try:
+          states = [subscriber.get(timeout=keepalive)]
+        except queue.Empty:
+          yield ": keepalive\n\n" # Also how we find out the viewer has gone
+          states = streamStates(id)
+    finally:
+      broadcaster.unsubscribe(subscriber)
+  response = Response(events(), mimetype='text/event-stream')
+  response.headers['Cache-Control'] = "no-cache"
+  response.headers['X-Accel-Buffering'] = "no" # Don't let a proxy hold on to the events
+  response.call_on_close(streams.release) # Even if the stream never got going
+  return response
+
+def streamStates(id):
+  '''
+    The devices a stream for id (None for every device) looks at, when it starts and when it checks for changes
+  '''
+  if id == None: return devices.all()
+  state = devices.get(id)
+  return [state] if state else []
+
+def streamEvent(state, id, versions):
+  '''
+    The message for state, for a stream of id (None for every device). None if the stream doesn't want it, or
+    has already sent this version of it. versions (id: version sent) is kept up to date
+  '''
+  if (id != None and state['id'] != id) or state['version'] <= versions.get(state['id'], -1):
+    return None
+  versions[state['id']] = state['version']
+  return "data: %s\n\n" % json.dumps(dict(public(state), now=int(time.time())), separators=(',', ':'))
+
+def public(state):
+  '''
+    The parts of the state of a device we show to anyone who asks
+  '''
+  fields = ('id', 'state', 'otime', 'ctime', 'odeadline', 'cdeadline', 'connstate', 'ip', 'port', 'version')
+  return {field: state[field] for field in fields}
+
+def expire(state, entries):
+  if state['connstate'] and not devices.alive(state):
+    state['connstate'] = False
+    entries.append((state['id'], "disconnect", {}))
+  return state
 
 @app.route('/handshake')
 def shake():
+  return handshakeReply(request.args)
+
+def handshakeReply(args):
   ''' Handshake between Coopener and SmartHome srvr
-        Coopener ---> SmartHome. Sends Coopener IP and shake=1. Expects response.
+        Coopener ---> SmartHome. Sends Coopener IP, its id and shake=1. Expects response.
         SmartHome ---> Coopener. Responds "OK(2)". Expects response.
-        Coopener ---> SmartHome. Sends shake=3. Expects response.
-  '''
-  global d
-  if request.args.get('shake'):
-    if request.args.get('shake') == "1": # Coopener is initiating handshake
-      if request.args.get('ip'): d['ip'] = request.args.get('ip') # grab the ip sent from coopener
-      if request.args.get('port'): d['port'] = request.args.get('port') # grab the port sent from coopener
-      d['connstate'] = False # Even if connection was already established, tear it down and let Coopener start again
-      return "OK(2)" 
-    if request.args.get('shake') == "3": # Coopener is completing handshake process
-      d['lastSeen'] = int(time.time()) # Number of seconds since epoch. This is when we last got a heartbeat
-      d['connstate'] = True # Connection to Coopener is now established
+        Coopener ---> SmartHome. Sends shake=3 and its id. Expects response.
+  '''
+  id = args.get('id', defaultId)
+  if args.get('shake') == "1": # Coopener is initiating handshake
+    def change(state):
+      if args.get('ip'): state['ip'] = args.get('ip') # grab the ip sent from coopener
+      if args.get('port'): state['port'] = args.get('port') # grab the port sent from coopener
+      state['connstate'] = False # Even if connection was already established, tear it down and let Coopener start again
+      state['seq'] = None # and wait for it to send everything again
+      state['commands'] = [] # Anything queued was meant for the connection that just went away
+      return "OK(2)"
+    return devices.update(id, change)
+  if args.get('shake') == "3" and devices.get(id) != None: # Coopener is completing handshake process
+    entries = []
+    def change(state):
+      state['lastSeen'] = int(time.time()) # Number of seconds since epoch. This is when we last got a heartbeat
+      state['connstate'] = True # Connection to Coopener is now established
+      liveness.touch(id, state['lastSeen'] + devices.timeout)
+      entries.append((id, "connect", {'ip': state['ip'], 'port': state['port']}))
       return "OK(4)"
+    reply = devices.update(id, change)
+    history.recordAll(entries)
+    return reply
+  return "No handshake found"
 
 @app.route('/heartbeat')
 def beat():
+  return heartbeatReply(request.args)
+
+@app.route('/heartbeats', methods=['POST'])
+def beats():
+  return heartbeatsReply(request.get_data(as_text=True))
+
+def heartbeatReply(args):
   '''
     Every n seconds Coopener should send a heartbeat/keepalive for the established connection
-    It will contain the current state of Coopener in it. Yes, its extra overhead... but its simpler.
-    I will need to re-write this entire protocol one day as it is really ugly and way too rigid.
-  '''
-  global d
-  if (d['connstate'] == True):
-    d['lastSeen'] = int(time.time()) # Number of seconds since epoch. This is when we last got a heartbeat
-    if request.args.get('otimeleft') and request.args.get('ctimeleft') and \
-                      request.args.get('otime') and request.args.get('ctime'): # Only parse if all data is received
-      d['otimeleft'] = int(request.args.get('otimeleft')) # Convert to integer the returned seconds
-      d['ctimeleft'] = int(request.args.get('ctimeleft'))
-      d['otime'] = request.args.get('otime')
-      d['ctime'] = request.args.get('ctime')
-      d['state'] = request.args.get('state')
-    return "OK(HB)"
-  else:
+    It only contains what has changed since its last heartbeat, along with a sequence number (hbeat).
+    A heartbeat with full=1 (or every field, like older Coopeners send) has everything in it.
+    Anything else is merged in to what we already have. If we don't have anything yet, Coopener is told
+    to "resync" and send everything. Heartbeats older than the last one used are only counted as a keepalive.
+  '''
+  reply = heartbeatReplies([args])[0]
+  if reply.startswith("Invalid heartbeat"):
+    return reply, 400
+  return reply
+
+def heartbeatsReply(body):
+  '''
+    A batch of heartbeats (eg. from a Pi running several doors) POSTed in one go. body has one heartbeat per
+    line, each the query string /heartbeat would get. The answer has the reply to each one, one per line, in order.
+    A line that doesn't make sense gets an "Invalid heartbeat" reply, the rest of the batch is still used.
+  '''
+  batch = [dict(urllib.parse.parse_qsl(line)) for line in body.splitlines() if line.strip()]
+  if len(batch) > maxBatch:
+    return "Too many heartbeats, at most " + str(maxBatch), 413
+  return "\n".join(heartbeatReplies(batch))
+
+def heartbeatReplies(batch):
+  '''
+    Applies each heartbeat (its args) in batch, all in one pass over the store. Returns the replies
+  '''
+  entries = [] # History of every heartbeat in the batch, recorded once they are all stored
+  def change(args):
+    def change(state):
+      reply = applyBeat(state, args, entries)
+      if reply.startswith("OK(HB)") and state['commands']: # Hand over any waiting commands, eg. "OK(HB);cmd=flip"
+        commands = [cmd for cmd, queued in state['commands'] if queued > int(time.time()) - commandTtl]
+        if commands: reply = reply + ";cmd=" + ",".join(commands) # Too old ones are dropped, it's too late for them
+        state['commands'] = []
+      return reply
+    return change
+  replies = [None] * len(batch)
+  changes = [] # (index in batch, heartbeat) of the heartbeats that make sense
+  for i, args in enumerate(batch):
+    try:
+      changes.append((i, checkBeat(args)))
+    except ValueError as e:
+      replies[i] = "Invalid heartbeat: " + str(e)
+  results = devices.updateMany([(beat.get('id', defaultId), change(beat)) for i, beat in changes], create=False)
+  history.recordAll(entries)
+  for (i, beat), reply in zip(changes, results):
+    replies[i] = reply or "No established connection found" # None if we don't know the device
+  return replies
+
+def checkBeat(args):
+  '''
+    The heartbeat args ready for applyBeat(): empty fields left out (they never meant anything) and the numbers
+    made in to ints. Raises ValueError if a number isn't one, before anything has been changed
+  '''
+  beat = {key: value for key, value in args.items() if value != ""}
+  for key in ('hbeat', 'otimeleft', 'ctimeleft'):
+    if key in beat:
+      try:
+        beat[key] = int(beat[key])
+      except ValueError:
+        raise ValueError(key + "=" + beat[key] + " is not a number")
+  return beat
+
+def applyBeat(state, args, entries):
+  '''
+    Merges the heartbeat args (see checkBeat()) in to state. Returns the response for Coopener.
+    What should go in the history is added to entries, see History.recordAll()
+  '''
+  if state['connstate'] != True:
     return "No established connection found"
+  state['lastSeen'] = int(time.time()) # Number of seconds since epoch. This is when we last got a heartbeat
+  liveness.touch(state['id'], state['lastSeen'] + devices.timeout)
+  seq = args.get('hbeat', 0)
+  full = args.get('full') == "1" or \
+         all(field in args for field in ('otimeleft', 'ctimeleft', 'otime', 'ctime', 'state'))
+  if not full:
+    if state['seq'] == None: # Don't have a full state to merge this in to
+      return "OK(HB);resync"
+    if seq <= state['seq']: # Arrived late, we already have something newer
+      return "OK(HB)"
+  if 'otimeleft' in args: # Count down the returned seconds from now
+    state['odeadline'] = state['lastSeen'] + args['otimeleft']
+  if 'ctimeleft' in args:
+    state['cdeadline'] = state['lastSeen'] + args['ctimeleft']
+  if args.get('otime'): state['otime'] = args.get('otime')
+  if args.get('ctime'): state['ctime'] = args.get('ctime')
+  if args.get('state') and args.get('state') != state['state']:
+    entries.append((state['id'], "state", {'state': args.get('state'), 'was': state['state']}))
+    state['state'] = args.get('state')
+  state['seq'] = seq
+  entries.append((state['id'], "beat", {'seq': seq, 'otime': state['otime'], 'ctime': state['ctime'], \
+                  'state': state['state'], 'odeadline': state['odeadline'], 'cdeadline': state['cdeadline']}))
+  return "OK(HB)"
+
+@app.route('/command')
+def command():
+  return queueCommand(request.args)
+
+def queueCommand(args):
+  '''
+    Queues a command (?cmd=flip or reconnect) for a door (?door=<id>). Coopener gets it with the answer to its
+    next heartbeat, so we don't need to be able to reach Coopener ourselves (it might be behind NAT).
+    Only a connected door takes commands, and they are dropped if no heartbeat comes for them within commandTtl
+    seconds, so a flip can't be done hours after it was asked for.
+    Returns the answer, with the HTTP status if it isn't 200
+  '''
+  id = args.get('door', defaultId)
+  cmd = args.get('cmd')
+  if cmd not in ("flip", "reconnect"):
+    return "Unknown command", 400
+  if devices.get(id) == None:
+    return "No device found", 404
+  def change(state):
+    if not devices.alive(state):
+      return "Not connected"
+    now = int(time.time())
+    commands = [entry for entry in state['commands'] if entry[1] > now - commandTtl]
+    if len(commands) >= maxCommands:
+      return "Too many"
+    state['commands'] = commands + [[cmd, now]] # A new list, the old state might still be being read
+    return None
+  problem = devices.update(id, change)
+  if problem == "Not connected":
+    return id + " is not connected", 409
+  if problem != None:
+    return "Too many commands waiting for " + id, 503
+  return "Queued " + cmd + " for " + id
+
+def timeLeft(deadline):
+  '''
+    Number of seconds from now until deadline (seconds since epoch). Not less than zero
+  '''
+  return max(0, deadline - int(time.time()))
 
 if __name__ == "__main__":
   #app.debug = True
+  # Flask's own server closes the connection after every request, so Coopener connects again for each heartbeat.
+  # Run under Apache/mod_wsgi (webtool.wsgi) or use webtool_async.py to have connections kept open.
   app.run(host='0.0.0.0')
\ No newline at end of file
@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+
+'''
+  SmartHome served from a single asyncio event loop instead of Flask's threads. It answers /, /handshake,
+  /heartbeat, /heartbeats, /command, /api/status and /events exactly like webtool.py does, because it calls
+  the same functions.
+  Each connection is a coroutine instead of a thread, so thousands of slow Coopener connections (and
+  dashboards left open on /events) only cost a little memory each. webtool.py is still the simple way to
+  run SmartHome (and under mod_wsgi), but it can only stream to webtool.maxStreams viewers at a time.
+
+  Run with: python3 webtool_async.py [port]
+'''
+
+import asyncio
+import mimetypes
+import os
+import sys
+import urllib.parse
+from http import HTTPStatus
+import jinja2
+import webtool
+
+here = os.path.dirname(os.path.abspath(__file__))
+idleTimeout = 75 # Seconds a connection can sit without sending a request before we close it
+paths = {'index': "/", 'status': "/api/status", 'stream': "/events", 'command': "/command"} # What url_for() gives
+
+def url_for(endpoint, filename=None):
+  if endpoint == 'static':
+    return "/static/" + filename
+  return paths[endpoint]
+
+templates = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.join(here, "templates")),
+                               autoescape=jinja2.select_autoescape(['html']))
+templates.globals['url_for'] = url_for
+
+def route(method, path, query, headers, body):
+  '''
+    Works out the answer to a request. Returns (status, content type, body, extra headers)
+  '''
+  args = dict(urllib.parse.parse_qsl(query))
+  if path == "/":
+    page = webtool.indexPage(lambda views: templates.get_template('index.html').render(devices=views))
+    return 200, "text/html; charset=utf-8", page, {}
+  if path == "/handshake":
+    return text(webtool.handshakeReply(args))
+  if path == "/heartbeat":
+    return text(webtool.heartbeatReply(args))
+  if path == "/heartbeats" and method == "POST":
+    return text(webtool.heartbeatsReply(body.decode("utf-8")))
+  if path == "/command":
+    return text(webtool.queueCommand(args))
+  if path == "/api/health":
+    return 200, "application/json", webtool.healthReply(), {}
+  if path == "/api/status":
+    found = webtool.statusOf(args.get('id'))
+    if found == None:
+      return text(("No device found", 404))
+    etag, makeBody = found
+    etag = '"' + etag + '"'
+    extra = {'ETag': etag, 'Cache-Control': "no-cache"}
+    if etag in [tag.strip().replace("W/", "") for tag in headers.get('if-none-match', "").split(",")]:
+      return 304, None, "", extra
+    return 200, "application/json", makeBody(), extra
+  if path.startswith("/static/"):
+    filename = os.path.join(here, "static", os.path.basename(path)) # basename, so nobody can leave static/
+    if os.path.isfile(filename):
+      with open(filename, "rb") as file:
+        return 200, mimetypes.guess_type(filename)[0] or "application/octet-stream", file.read(), {}
+  return text(("Not found", 404))
+
+class LoopQueue:
+  '''
+    A webtool.Broadcaster subscriber for a coroutine. Messages can be published from any thread (eg. one
+    running SQLite for us), they are handed over to the loop, and dropped if the stream isn't keeping up
+  '''
+  def __init__(self, loop, size):
+    self.loop = loop
+    self.queue = asyncio.Queue(size)
+
+  def put_nowait(self, message): # Called by the broadcaster
+    try:
+      self.loop.call_soon_threadsafe(self.put, message)
+    except RuntimeError: # Loop has stopped
+      pass
+
+  def put(self, message):
+    try:
+      self.queue.put_nowait(message)
+    except asyncio.QueueFull:
+      pass
+
+async def stream(reader, writer, args, blocking):
+  '''
+    /events (see webtool.stream()). The connection is kept for the stream, which only ends when the viewer goes
+    (the browser doesn't send anything else, so anything read means it has)
+  '''
+  loop = asyncio.get_running_loop()
+  id = args.get('id')
+  async def states():
+    if blocking: return await loop.run_in_executor(None, webtool.streamStates, id)
+    return webtool.streamStates(id)
+  subscriber = webtool.broadcaster.subscribe(LoopQueue(loop, webtool.broadcaster.size))
+  gone = asyncio.ensure_future(reader.read(1))
+  try:
+    writer.write(("HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                  "X-Accel-Buffering: no\r\nConnection: close\r\n\r\n").encode("latin-1"))
+    versions = {} # id: version last sent
+    found = await states()
+    while True:
+      for state in found:
+        event = webtool.streamEvent(state, id, versions)
+        if event: writer.write(event.encode())
+      await writer.drain()
+      message = asyncio.ensure_future(subscriber.queue.get())
+      await asyncio.wait((message, gone), timeout=webtool.keepalive, return_when=asyncio.FIRST_COMPLETED)
+      if gone.done():
+        message.cancel()
+        return
+      if message.done():
+        found = [message.result()]
+      else:
+        message.cancel()
+        writer.write(b": keepalive\n\n")
+        await writer.drain()
+        found = await states()
+  finally:
+    gone.cancel()
+    webtool.broadcaster.unsubscribe(subscriber)
+
+def text(answer):
+  '''
+    The answer from a webtool function (a string, or (string, status)) as route() returns it
+  '''
+  if isinstance(answer, tuple):
+    return answer[1], "text/html; charset=utf-8", answer[0], {}
+  return 200, "text/html; charset=utf-8", answer, {}
+
+async def serve(reader, writer):
+  '''
+    One client connection. Requests are answered in turn, and the connection is kept open between them
+    (HTTP/1.1) so Coopeners don't have to connect for every heartbeat
+  '''
+  loop = asyncio.get_running_loop()
+  blocking = webtool.stateStore == "sqlite" # SQLite can wait on other processes, so don't do that in the loop
+  try:
+    while True:
+      try:
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), idleTimeout)
+      except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        break
+      lines = head.decode("latin-1").split("\r\n")
+      try:
+        method, target, version = lines[0].split(" ")
+      except ValueError:
+        await respond(writer, (400, "text/plain", "Bad request", {}), False)
+        break
+      headers = {}
+      for line in lines[1:]:
+        if ":" in line:
+          name, value = line.split(":", 1)
+          headers[name.strip().lower()] = value.strip()
+      try:
+        length = int(headers.get('content-length') or 0)
+        body = await asyncio.wait_for(reader.readexactly(length), idleTimeout) if length > 0 else b""
+      except (ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        break
+      path, _, query = target.partition("?")
+      if path == "/events":
+        await stream(reader, writer, dict(urllib.parse.parse_qsl(query)), blocking)
+        break
+      try:
+        if blocking: answer = await loop.run_in_executor(None, route, method, path, query, headers, body)
+        else: answer = route(method, path, query, headers, body)
+      except Exception:
+        webtool.app.logger.exception("Could not answer %s %s", method, target)
+        answer = (500, "text/plain", "Internal server error", {})
+      connection = headers.get('connection', "").lower()
+      keepAlive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+      await respond(writer, answer, keepAlive)
+      if not keepAlive:
+        break
+  except ConnectionError:
+    pass
+  finally:
+    writer.close()
+
+async def respond(writer, answer, keepAlive):
+  status, contentType, body, extra = answer
+  if isinstance(body, str):
+    body = body.encode()
+  head = ["HTTP/1.1 %d %s" % (status, HTTPStatus(status).phrase),
+          "Content-Length: %d" % len(body),
+          "Connection: " + ("keep-alive" if keepAlive else "close")]
+  if contentType:
+    head.append("Content-Type: " + contentType)
+  head.extend(name + ": " + value for name, value in extra.items())
+  writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+  await writer.drain()
+
+async def main(host="0.0.0.0", port=5000):
+  webtool.liveness.start() # Flask starts it on the first request, we don't go through Flask
+  server = await asyncio.start_server(serve, host, port, backlog=1024)
+  async with server:
+    await server.serve_forever()
+
+if __name__ == "__main__":
+  asyncio.run(main(port=int(sys.argv[1]) if len(sys.argv) > 1 else 5000))